@@ -0,0 +1,43 @@
+import multiprocessing
+import sys
+import time
+
+import java
+import parallel
+
+if len(sys.argv) < 2:
+    print "Usage %s PATH [PROCESSES]" % (sys.argv[0], )
+    sys.exit(1)
+
+path = sys.argv[1]
+processes = int(sys.argv[2]) if len(sys.argv) > 2 else multiprocessing.cpu_count()
+
+serial = java.Class(path)
+serial.parse()
+mapping = dict([(i, i) for i in xrange(0, serial.constantPoolSize)])
+
+start = time.time()
+serial.update(mapping)
+serialTime = time.time() - start
+
+sharded = java.Class(path)
+sharded.parse()
+
+# With one process parallel.update runs serially and no pool is made
+pool = multiprocessing.Pool(processes) if processes > 1 else None
+start = time.time()
+parallel.update(sharded, mapping, processes, pool)
+parallelTime = time.time() - start
+if pool is not None:
+    pool.close()
+    pool.join()
+
+if serial.data() != sharded.data():
+    print "Serial and parallel output differ"
+    sys.exit(1)
+
+print "Methods: %d" % (len(serial.methods), )
+print "Code bytes: %d" % (sum([len(attribute.code) for attribute in serial.codeAttributes()]), )
+print "Serial: %.3fs" % (serialTime, )
+print "Parallel (%d processes): %.3fs" % (processes, parallelTime)
+print "Speedup: %.2fx" % (serialTime / max(parallelTime, 1e-9), )
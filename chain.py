@@ -0,0 +1,222 @@
+import heapq
+import json
+import os
+import sys
+from cStringIO import StringIO
+
+import container
+import java
+
+
+# Rough cost in bytes of parsing and serializing a class once more, added for
+# every patch on a path so fewer hops win over slightly smaller patches
+HOP_COST = 64
+
+
+def compose(first, second):
+    # Single old -> newest patch doing the same as applying first and then
+    # second, without building the intermediate class
+    firstMapping = first.mapping()
+    secondMapping = second.mapping()
+    firstDeleted = set(first.delIndexes)
+    secondDeleted = set(second.delIndexes)
+
+    mapping = {}
+    delIndexes = []
+    for old in xrange(0, first.size):
+        middle = firstMapping[old]
+        if old in firstDeleted or middle in secondDeleted:
+            delIndexes.append(old)
+        mapping[old] = secondMapping.get(middle, 0)
+
+    constants = dict(zip(second.newIndexes, second.constants))
+    for middle, data in zip(first.newIndexes, first.constants):
+        if middle in secondDeleted:
+            continue
+
+        # Constants added by the first patch refer to the intermediate pool
+        constant = java.Class.parseConstant(data, {})
+        constant.update(secondMapping)
+
+        index = secondMapping[middle]
+        if index in constants:
+            raise java.ClassError("Composed patches both add a constant at %d" % (index, ))
+        constants[index] = constant.data()
+
+    newIndexes = sorted(constants)
+
+    return java.Patch.create(first.size, delIndexes, newIndexes, [constants[i] for i in newIndexes], mapping)
+
+
+def composeAll(patches):
+    patch = patches[0]
+    for other in patches[1:]:
+        patch = compose(patch, other)
+
+    return patch
+
+
+def check(cls, patches):
+    # The composed patch has to give the same class as applying the patches
+    # one after the other. cls is the class the first patch was made from
+    data = cls.data()
+
+    sequential = java.Class(cls.path)
+    sequential.parseFile(StringIO(data))
+    for patch in patches:
+        patch.apply(sequential)
+
+    composed = java.Class(cls.path)
+    composed.parseFile(StringIO(data))
+    composeAll(patches).apply(composed)
+
+    if sequential.data() != composed.data():
+        return ["%s: composed patch differs from applying %d patches in sequence" % (cls.path, len(patches))]
+
+    return []
+
+
+class PatchGraph(object):
+
+    def __init__(self):
+        self.edges = {}
+
+    def add(self, fromVersion, toVersion, patches, cost=None):
+        # patches is a dict of path -> Patch for everything that changed
+        # between the two versions
+        if cost is None:
+            cost = HOP_COST + sum([len(patch.data()) for patch in patches.itervalues()])
+
+        self.edges.setdefault(fromVersion, {})[toVersion] = (cost, patches)
+        self.edges.setdefault(toVersion, {})
+
+    def path(self, fromVersion, toVersion):
+        # Cheapest chain of versions from fromVersion to toVersion
+        queue = [(0, fromVersion, [fromVersion])]
+        done = set()
+
+        while queue:
+            cost, version, path = heapq.heappop(queue)
+            if version == toVersion:
+                return path
+
+            if version in done:
+                continue
+            done.add(version)
+
+            for nextVersion, (edgeCost, patches) in self.edges.get(version, {}).iteritems():
+                if nextVersion not in done:
+                    heapq.heappush(queue, (cost + edgeCost, nextVersion, path + [nextVersion]))
+
+        raise KeyError("No patch path from %s to %s" % (fromVersion, toVersion))
+
+    def patches(self, fromVersion, toVersion):
+        # Compacts the cheapest path into one patch per class path
+        versions = self.path(fromVersion, toVersion)
+
+        chains = {}
+        for i in xrange(0, len(versions) - 1):
+            cost, patches = self.edges[versions[i]][versions[i + 1]]
+            for path, patch in patches.iteritems():
+                chains.setdefault(path, []).append(patch)
+
+        return dict([(path, composeAll(patches)) for path, patches in chains.iteritems()])
+
+    def compact(self, fromVersion, toVersion):
+        # Stores the composed patches as a direct edge so later clients on
+        # fromVersion get them in one hop
+        patches = self.patches(fromVersion, toVersion)
+        self.add(fromVersion, toVersion, patches)
+
+        return patches
+
+    def save(self, directory):
+        # One container per edge and graph.json listing the edges, so a
+        # graph can be kept next to the releases and extended later
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        edges = []
+        for fromVersion in sorted(self.edges):
+            for toVersion, (cost, patches) in sorted(self.edges[fromVersion].iteritems()):
+                name = "%d.patch" % (len(edges), )
+                with open(os.path.join(directory, name), "wb") as fp:
+                    writePatches(fp, patches)
+                edges.append({"from": fromVersion, "to": toVersion, "cost": cost, "patches": name})
+
+        with open(os.path.join(directory, GRAPH), "wb") as fp:
+            json.dump({"edges": edges}, fp, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, directory):
+        graph = cls()
+        path = os.path.join(directory, GRAPH)
+        if not os.path.exists(path):
+            return graph
+
+        with open(path, "rb") as fp:
+            edges = json.load(fp)["edges"]
+
+        for edge in edges:
+            with open(os.path.join(directory, edge["patches"]), "rb") as fp:
+                patches = readPatches(fp)
+            graph.add(str(edge["from"]), str(edge["to"]), patches, edge["cost"])
+
+        return graph
+
+
+# Edge list in a graph directory
+GRAPH = "graph.json"
+
+
+def readPatches(fp):
+    # Class patches of a container as written by patch.py. Debug streams
+    # (PATH#debug) are per pair of versions and can not be composed, so
+    # they are left out
+    reader = container.ContainerReader(fp)
+
+    return dict([(path, reader.read(path)) for path in reader.paths() if "#" not in path])
+
+
+def writePatches(fp, patches):
+    writer = container.ContainerWriter(fp)
+    for path in sorted(patches):
+        writer.add(path, patches[path])
+    writer.close()
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    compact = "--compact" in sys.argv[1:]
+
+    if len(args) != 5 or args[1] not in ("add", "emit"):
+        print "Usage %s GRAPH add FROM TO PATCH" % (sys.argv[0], )
+        print "      %s [--compact] GRAPH emit FROM TO OUTPUT" % (sys.argv[0], )
+        print "add stores a patch container made by patch.py as the edge FROM -> TO,"
+        print "emit writes one container taking a client on FROM to TO over the"
+        print "cheapest path, --compact also keeps it as a direct edge"
+        sys.exit(1)
+
+    directory, command, fromVersion, toVersion, path = args
+    graph = PatchGraph.load(directory)
+
+    if command == "add":
+        with open(path, "rb") as fp:
+            graph.add(fromVersion, toVersion, readPatches(fp))
+        graph.save(directory)
+        sys.exit(0)
+
+    try:
+        if compact:
+            patches = graph.compact(fromVersion, toVersion)
+            graph.save(directory)
+        else:
+            patches = graph.patches(fromVersion, toVersion)
+    except KeyError, e:
+        print >> sys.stderr, e.args[0]
+        sys.exit(1)
+
+    with open(path, "wb") as fp:
+        writePatches(fp, patches)
+
+    print "%s -> %s: %s, %d classes" % (fromVersion, toVersion, " -> ".join(graph.path(fromVersion, toVersion)), len(patches))
@@ -0,0 +1,101 @@
+import struct
+import zlib
+
+import java
+
+
+# Layout: header, one zlib compressed section per entry holding the
+# Patch.data() records, the compressed index and a trailer with the offset
+# of the index. Readers seek straight to the entries they need.
+MAGIC = "JCPC"
+VERSION = 1
+
+HEADER = struct.Struct(">4sB")
+TRAILER = struct.Struct(">I")
+
+
+class ContainerError(Exception):
+    pass
+
+
+class ContainerWriter(object):
+
+    def __init__(self, fp, level=9):
+        self.fp = fp
+        self.level = level
+        self.entries = []
+
+        self.fp.write(HEADER.pack(MAGIC, VERSION))
+        self.offset = HEADER.size
+
+    def add(self, path, patch):
+        self.addData(path, patch.data())
+
+    def addData(self, path, data):
+        section = zlib.compress(data, self.level)
+
+        self.fp.write(section)
+        self.entries.append((path, self.offset, len(section), len(data)))
+        self.offset += len(section)
+
+    def close(self):
+        index = java.writeVarint(len(self.entries))
+        last = HEADER.size
+        for path, offset, length, rawLength in self.entries:
+            index += java.writeVarint(len(path)) + path
+            index += java.writeVarint(offset - last) + java.writeVarint(length) + java.writeVarint(rawLength)
+            last = offset
+
+        self.fp.write(zlib.compress(index, self.level))
+        self.fp.write(TRAILER.pack(self.offset))
+
+
+class ContainerReader(object):
+
+    def __init__(self, fp):
+        self.fp = fp
+
+        magic, version = HEADER.unpack(self.fp.read(HEADER.size))
+        if magic != MAGIC:
+            raise ContainerError("Wrong magic")
+        if version != VERSION:
+            raise ContainerError("Unsupported version %d" % (version, ))
+
+        self.fp.seek(-TRAILER.size, 2)
+        end = self.fp.tell()
+        indexOffset = TRAILER.unpack(self.fp.read(TRAILER.size))[0]
+
+        self.fp.seek(indexOffset)
+        index = zlib.decompress(self.fp.read(end - indexOffset))
+
+        self.entries = {}
+        self.order = []
+        count, pos = java.readVarint(index, 0)
+        last = HEADER.size
+        for i in xrange(0, count):
+            length, pos = java.readVarint(index, pos)
+            path = index[pos:pos + length]
+            pos += length
+
+            delta, pos = java.readVarint(index, pos)
+            length, pos = java.readVarint(index, pos)
+            rawLength, pos = java.readVarint(index, pos)
+            last += delta
+
+            self.entries[path] = (last, length, rawLength)
+            self.order.append(path)
+
+    def paths(self):
+        return list(self.order)
+
+    def data(self, path):
+        offset, length, rawLength = self.entries[path]
+        self.fp.seek(offset)
+        data = zlib.decompress(self.fp.read(length))
+        if len(data) != rawLength:
+            raise ContainerError("%s: section is %d bytes, expected %d" % (path, len(data), rawLength))
+
+        return data
+
+    def read(self, path):
+        return java.Patch.parse(self.data(path))
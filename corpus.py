@@ -0,0 +1,282 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from cStringIO import StringIO
+from distutils.spawn import find_executable
+
+import container
+import java
+
+
+# Runs parse -> diff -> serialize -> bsdiff -> apply on every old/new pair
+# under a corpus directory laid out like patch.py expects (DIR/old/PATH and
+# DIR/new/PATH, classes or jars) and compares the totals with a baseline.
+
+PHASES = ("parse", "diff", "serialize", "bsdiff", "apply")
+
+# Allowed growth over the baseline before the run fails
+THRESHOLDS = {
+    "size": 0.02,
+    "time": 0.25,
+    "memory": 0.25,
+}
+
+# Growth smaller than this (bytes, seconds, KB) is noise whatever the
+# percentage, a phase that takes milliseconds easily varies by half
+MIN_GROWTH = {
+    "size": 0,
+    "time": 0.05,
+    "memory": 1024,
+}
+
+# Every pair is timed this many times and the fastest run of each phase
+# is kept
+RUNS = 3
+
+bsdiff4 = None
+bsdiff4Loaded = False
+
+
+def loadBsdiff():
+    global bsdiff4, bsdiff4Loaded
+
+    if not bsdiff4Loaded:
+        bsdiff4Loaded = True
+        try:
+            import bsdiff4 as module
+            bsdiff4 = module
+        except ImportError:
+            pass
+
+    return bsdiff4
+
+
+def runTool(args, *inputs):
+    # Runs bsdiff/bspatch style tools that work on files, the last argument
+    # is the output
+    paths = []
+    try:
+        for data in inputs:
+            fd, path = tempfile.mkstemp()
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            paths.append(path)
+
+        fd, output = tempfile.mkstemp()
+        os.close(fd)
+        paths.append(output)
+
+        subprocess.check_call(args + paths)
+        with open(output, "rb") as fp:
+            return fp.read()
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+def hasBsdiff():
+    return loadBsdiff() is not None or (find_executable("bsdiff") is not None and find_executable("bspatch") is not None)
+
+
+def bsdiff(old, new):
+    if loadBsdiff() is not None:
+        return bsdiff4.diff(old, new)
+
+    return runTool(["bsdiff"], old, new)
+
+
+def bspatch(old, patch):
+    if loadBsdiff() is not None:
+        return bsdiff4.patch(old, patch)
+
+    return runTool(["bspatch"], old, patch)
+
+
+def parse(path, data):
+    cls = java.Class(path)
+    cls.parseFile(StringIO(data))
+
+    return cls
+
+
+def pairs(root):
+    # Yields (name, old bytes, new bytes) for every class present on both
+    # sides, jars are opened and paired entry by entry
+    old = os.path.join(root, "old")
+    new = os.path.join(root, "new")
+
+    for dirpath, dirnames, filenames in os.walk(new):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            newPath = os.path.join(dirpath, filename)
+            path = os.path.relpath(newPath, new)
+            oldPath = os.path.join(old, path)
+            if not os.path.exists(oldPath):
+                continue
+
+            if filename.endswith(".class"):
+                with open(oldPath, "rb") as fp:
+                    oldData = fp.read()
+                with open(newPath, "rb") as fp:
+                    newData = fp.read()
+                yield path, oldData, newData
+            elif filename.endswith(".jar"):
+                oldJar = zipfile.ZipFile(oldPath)
+                newJar = zipfile.ZipFile(newPath)
+                names = set(oldJar.namelist())
+                for name in sorted(newJar.namelist()):
+                    if name.endswith(".class") and name in names:
+                        yield path +"!"+ name, oldJar.read(name), newJar.read(name)
+
+
+def measure(name, oldData, newData, withBsdiff=True, engine=None):
+    # Without bsdiff the last two phases only check that applying the pool
+    # patch gives the same class as diffing did
+    times = dict([(phase, 0.0) for phase in PHASES])
+
+    start = time.time()
+    org = parse(name, oldData)
+    reference = parse(name, newData)
+    times["parse"] = time.time() - start
+
+    start = time.time()
+    # When only the pool differs the pool patch alone gives the new class
+    # and bsdiff is skipped
+    poolOnly = not [difference for difference in org.compare(reference) if difference != "pool"]
+    patch = org.diff(reference, engine)
+    times["diff"] = time.time() - start
+
+    start = time.time()
+    guess = org.data()
+    fp = StringIO()
+    writer = container.ContainerWriter(fp)
+    writer.add(name, patch)
+    writer.close()
+    patchData = fp.getvalue()
+    times["serialize"] = time.time() - start
+
+    delta = ""
+    if withBsdiff and not poolOnly:
+        start = time.time()
+        delta = bsdiff(guess, newData)
+        times["bsdiff"] = time.time() - start
+
+    # What a client does: apply the pool patch to the old class, then the
+    # bsdiff on top of that
+    start = time.time()
+    client = parse(name, oldData)
+    container.ContainerReader(StringIO(patchData)).read(name).apply(client, engine)
+    result = client.data()
+    if withBsdiff and not poolOnly:
+        result = bspatch(result, delta)
+    times["apply"] = time.time() - start
+
+    return {
+        "size": len(patchData) + len(delta),
+        "bsdiffOnly": len(bsdiff(oldData, newData)) if withBsdiff else None,
+        "time": times,
+        "ok": result == (newData if withBsdiff or poolOnly else guess),
+        "poolOnly": poolOnly,
+    }
+
+
+def run(root, engine=None, runs=RUNS):
+    withBsdiff = hasBsdiff()
+
+    results = {}
+    for name, oldData, newData in pairs(root):
+        try:
+            result = measure(name, oldData, newData, withBsdiff, engine)
+            for i in xrange(1, runs):
+                times = measure(name, oldData, newData, withBsdiff, engine)["time"]
+                for phase in PHASES:
+                    result["time"][phase] = min(result["time"][phase], times[phase])
+            results[name] = result
+        except Exception, e:
+            results[name] = {"error": str(e)}
+
+    measured = [result for result in results.itervalues() if "error" not in result]
+
+    return {
+        "pairs": results,
+        "size": sum([result["size"] for result in measured]),
+        "bsdiff": withBsdiff,
+        "bsdiffOnly": sum([result["bsdiffOnly"] or 0 for result in measured]),
+        "time": dict([(phase, sum([result["time"][phase] for result in measured])) for phase in PHASES]),
+        # Peak resident size of this process in KB
+        "memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "poolOnly": len([result for result in measured if result["poolOnly"]]),
+        "failed": sorted([name for name, result in results.iteritems() if "error" in result or not result["ok"]]),
+    }
+
+
+def compare(report, baseline, thresholds=THRESHOLDS):
+    problems = []
+
+    def check(what, value, base, threshold, minimum):
+        if base and value > base * (1 + threshold) and value - base > minimum:
+            problems.append("%s: %s, baseline %s (+%.1f%%)" % (what, value, base, 100.0 * (value - base) / base))
+
+    if report["bsdiff"] != baseline.get("bsdiff"):
+        # Sizes and times are not comparable when one run had no bsdiff
+        problems.append("bsdiff: %s, baseline %s" % (report["bsdiff"], baseline.get("bsdiff")))
+        return problems
+
+    check("size", report["size"], baseline.get("size"), thresholds["size"], MIN_GROWTH["size"])
+    check("memory", report["memory"], baseline.get("memory"), thresholds["memory"], MIN_GROWTH["memory"])
+
+    total = sum(report["time"].values())
+    check("time", total, sum(baseline.get("time", {}).values()), thresholds["time"], MIN_GROWTH["time"])
+    for phase in PHASES:
+        check("time %s" % (phase, ), report["time"][phase], baseline.get("time", {}).get(phase), thresholds["time"], MIN_GROWTH["time"])
+
+    for name in report["failed"]:
+        if name not in baseline.get("failed", []):
+            problems.append("%s: no longer round-trips" % (name, ))
+
+    return problems
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict([arg[2:].split("=", 1) if "=" in arg else (arg[2:], True) for arg in sys.argv[1:] if arg.startswith("--")])
+
+    if len(args) != 1 or options.get("engine") not in java.ENGINES + (None, ):
+        print "Usage %s [--baseline=FILE] [--update] [--engine=numpy|parallel] [--runs=N] [--size=F] [--time=F] [--memory=F] DIR" % (sys.argv[0], )
+        sys.exit(1)
+
+    baselinePath = options.get("baseline", os.path.join(args[0], "baseline.json"))
+    thresholds = dict(THRESHOLDS)
+    for key in thresholds:
+        if key in options:
+            thresholds[key] = float(options[key])
+
+    report = run(args[0], options.get("engine"), int(options.get("runs", RUNS)))
+
+    print "Pairs: %d (%d failed, %d pool only)" % (len(report["pairs"]), len(report["failed"]), report["poolOnly"])
+    if report["bsdiff"]:
+        print "Patch size: %d bytes (bsdiff only: %d bytes)" % (report["size"], report["bsdiffOnly"])
+    else:
+        print "Patch size: %d bytes (no bsdiff found, pool patches only)" % (report["size"], )
+    for phase in PHASES:
+        print "Time %s: %.3fs" % (phase, report["time"][phase])
+    print "Peak memory: %d KB" % (report["memory"], )
+
+    if options.get("update") or not os.path.exists(baselinePath):
+        with open(baselinePath, "wb") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+        print "Baseline written to %s" % (baselinePath, )
+        sys.exit(0)
+
+    with open(baselinePath, "rb") as fp:
+        problems = compare(report, json.load(fp), thresholds)
+
+    for problem in problems:
+        print >> sys.stderr, problem
+
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,162 @@
+from cStringIO import StringIO
+
+import java
+
+
+# How debug attributes are handled, they are taken out of the code before
+# diffing and travel in their own stream:
+# STRIP drops them, CARRY keeps the old ones for methods whose code did not
+# change and drops the rest, DIFF carries the ones that are identical and
+# encodes the others column by column so the output matches exactly
+STRIP = "strip"
+CARRY = "carry"
+DIFF = "diff"
+MODES = (STRIP, CARRY, DIFF)
+
+# Method records
+CARRIED = "\x00"
+ENCODED = "\x01"
+
+# Attribute records
+LINE_NUMBERS = "\x01"
+LOCAL_VARIABLES = "\x02"
+
+
+def isDebug(attribute):
+    return isinstance(attribute, (java.LineNumberTableAttribute, java.LocalVariableTableAttribute))
+
+
+def split(cls):
+    # Takes the debug attributes out of every code attribute. Returns method
+    # name -> (code structure, debug structure, debug attributes, positions)
+    pool = cls.constantPool
+    java.computeKeys(pool)
+
+    debug = {}
+    for method in cls.methods:
+        for code in method.attributes:
+            if not isinstance(code, java.CodeAttribute):
+                continue
+
+            positions = [i for i, attribute in enumerate(code.attributes) if isDebug(attribute)]
+            if not positions:
+                continue
+
+            attributes = [code.attributes[i] for i in positions]
+
+            code.attributes = [attribute for attribute in code.attributes if not isDebug(attribute)]
+
+            debug[method.name(pool)] = (code.structure(pool), tuple([attribute.structure(pool) for attribute in attributes]), attributes, positions)
+
+    return debug
+
+
+def names(cls):
+    # Method names in method order, for apply() once the pool is patched
+    return [method.name(cls.constantPool) for method in cls.methods]
+
+
+def encodeAttribute(attribute):
+    if isinstance(attribute, java.LineNumberTableAttribute):
+        buf = LINE_NUMBERS + java.writeVarint(attribute.nameIndex)
+        buf += java.writeIndexes([lineNumber.pc for lineNumber in attribute.lineNumbers])
+        buf += java.writeIndexes([lineNumber.lineNumber for lineNumber in attribute.lineNumbers])
+        return buf
+
+    buf = LOCAL_VARIABLES + java.writeVarint(attribute.nameIndex)
+    for column in ("startPc", "length", "nameIndex", "descriptorIndex", "index"):
+        buf += java.writeIndexes([getattr(localVariable, column) for localVariable in attribute.localVariables])
+
+    return buf
+
+
+def decodeAttribute(data, pos, pool):
+    # Rebuilds the attribute in class file form and parses that
+    kind = data[pos]
+    nameIndex, pos = java.readVarint(data, pos + 1)
+
+    if kind == LINE_NUMBERS:
+        pcs, pos = java.readIndexes(data, pos)
+        lines, pos = java.readIndexes(data, pos)
+        raw = java.ATTRIBUTE_U16.pack(nameIndex, 2 + 4 * len(pcs), len(pcs))
+        raw += "".join([java.U16X2.pack(pc, line) for pc, line in zip(pcs, lines)])
+    elif kind == LOCAL_VARIABLES:
+        columns = []
+        for i in xrange(0, 5):
+            column, pos = java.readIndexes(data, pos)
+            columns.append(column)
+        raw = java.ATTRIBUTE_U16.pack(nameIndex, 2 + 10 * len(columns[0]), len(columns[0]))
+        raw += "".join([java.U16X5.pack(*row) for row in zip(*columns)])
+    else:
+        raise java.ClassError("Unknown debug record %d" % (ord(kind), ))
+
+    reader = java.Reader(StringIO(raw))
+    return java.Attribute.parse(reader, pool), pos
+
+
+def encode(oldDebug, newDebug, mode):
+    # The debug stream for going from oldDebug to newDebug, both from split()
+    if mode == STRIP:
+        return ""
+
+    buf = ""
+    count = 0
+    for name in sorted(newDebug):
+        codeStructure, debugStructure, attributes, positions = newDebug[name]
+        old = oldDebug.get(name)
+
+        if mode == CARRY:
+            if old is None or old[0] != codeStructure:
+                continue
+            record = CARRIED
+        elif old is not None and old[0] == codeStructure and old[1] == debugStructure:
+            record = CARRIED
+        else:
+            record = ENCODED + java.writeVarint(len(attributes))
+            record += "".join([encodeAttribute(attribute) for attribute in attributes])
+
+        buf += java.writeVarint(len(name)) + name + java.writeIndexes(positions) + record
+        count += 1
+
+    return java.writeVarint(count) + buf
+
+
+def apply(cls, oldDebug, data, mapping, methodNames):
+    # Puts debug attributes back into a patched class. Carried attributes
+    # come from oldDebug and are remapped, encoded ones already use the new
+    # pool indexes. methodNames comes from names() before the patch, the
+    # name constants of the methods may be gone from the patched pool
+    if not data:
+        return
+
+    debug = {}
+    count, pos = java.readVarint(data, 0)
+    for i in xrange(0, count):
+        length, pos = java.readVarint(data, pos)
+        name = data[pos:pos + length]
+        positions, pos = java.readIndexes(data, pos + length)
+        record = data[pos]
+        pos += 1
+
+        if record == CARRIED:
+            attributes = oldDebug[name][2]
+            for attribute in attributes:
+                attribute.update(mapping)
+        else:
+            n, pos = java.readVarint(data, pos)
+            attributes = []
+            for j in xrange(0, n):
+                attribute, pos = decodeAttribute(data, pos, cls.constantPool)
+                attributes.append(attribute)
+
+        debug[name] = zip(positions, attributes)
+
+    for method, name in zip(cls.methods, methodNames):
+        attributes = debug.get(name)
+        if not attributes:
+            continue
+
+        for code in method.attributes:
+            if isinstance(code, java.CodeAttribute):
+                for position, attribute in attributes:
+                    code.attributes.insert(position, attribute)
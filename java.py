@@ -1,5 +1,38 @@
-import copy
+import array
+import collections
+import hashlib
+import itertools
 import struct
+from cStringIO import StringIO
+
+
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+U16X2 = struct.Struct(">HH")
+U16X3 = struct.Struct(">HHH")
+U16X4 = struct.Struct(">HHHH")
+U16X5 = struct.Struct(">HHHHH")
+I32 = struct.Struct(">i")
+I32X2 = struct.Struct(">ii")
+TAG_U16 = struct.Struct(">cH")
+TAG_U16X2 = struct.Struct(">cHH")
+# Attribute name index and length, optionally followed by a count
+ATTRIBUTE = struct.Struct(">HI")
+ATTRIBUTE_U16 = struct.Struct(">HIH")
+CODE_HEADER = struct.Struct(">HIHHI")
+
+# How many decoded descriptors are kept, shared by every class
+DESCRIPTOR_CACHE_SIZE = 4096
+
+# Method access flag
+STATIC = 0x0008
+
+# Engines for Class.diff and Patch.apply besides plain Python: NUMPY matches
+# the pools and remaps the code with NumPy (pool.py), PARALLEL rewrites the
+# code in a process pool (parallel.py)
+NUMPY = "numpy"
+PARALLEL = "parallel"
+ENGINES = (NUMPY, PARALLEL)
 
 
 def indent(buf, c):
@@ -10,30 +43,259 @@ def indent(buf, c):
     return ret
 
 
+# Stands in for index 0 when checking members that may still point at
+# constants a patch deleted
+DELETED = object()
+
+
+def checkIndex(pool, index, types, name, errors, optional=False):
+    if optional and index == 0:
+        return
+
+    constant = pool.get(index)
+    if constant is DELETED:
+        return
+    if constant is None:
+        errors.append("%s: index %d out of range" % (name, index))
+    elif not isinstance(constant, types):
+        errors.append("%s: index %d points at %s" % (name, index, constant.__class__.__name__))
+
+
+def opcodeTable(ranges):
+    # Opcode -> value from (first, last, value) ranges of opcodes
+    table = {}
+    for first, last, value in ranges:
+        for opcode in xrange(first, last + 1):
+            table[chr(opcode)] = value
+
+    return table
+
+
+def loadEngine(engine):
+    # pool and parallel import this module, so they are imported on use
+    if engine == NUMPY:
+        import pool
+        return pool
+    if engine == PARALLEL:
+        import parallel
+        return parallel
+
+    raise ValueError("Unknown engine %s" % (engine, ))
+
+
+def resolve(pool, index):
+    # Key of the constant at index, without any pool indexes
+    if index == 0:
+        return None
+
+    return pool[index].key()
+
+
+def computeKeys(pool):
+    # Fill the key cache bottom-up so no key is resolved more than once
+    for depth in xrange(0, 3):
+        for constant in pool.itervalues():
+            if constant.DEPTH == depth:
+                constant.key()
+
+
+def writeVarint(n):
+    buf = ""
+    while n > 0x7f:
+        buf += chr(0x80 | (n & 0x7f))
+        n >>= 7
+
+    return buf + chr(n)
+
+
+def readVarint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def writeIndexes(indexes):
+    # Count followed by zigzag coded deltas, small for the mostly ascending
+    # index lists a diff produces
+    buf = writeVarint(len(indexes))
+    last = 0
+    for index in indexes:
+        delta = index - last
+        buf += writeVarint(delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        last = index
+
+    return buf
+
+
+def readIndexes(buf, pos):
+    count, pos = readVarint(buf, pos)
+    indexes = []
+    last = 0
+    for i in xrange(0, count):
+        delta, pos = readVarint(buf, pos)
+        last += delta >> 1 if not delta & 1 else -((delta + 1) >> 1)
+        indexes.append(last)
+
+    return indexes, pos
+
+
 class ClassError(Exception):
     pass
 
 
 class Reader(object):
 
-    def __init__(self, fp):
+    def __init__(self, fp, stream=False):
         self.fp = fp
+        # Leave code arrays in the file instead of reading them
+        self.stream = stream
 
     def readU16(self):
-        return struct.unpack(">H", self.fp.read(2))[0]
+        return U16.unpack(self.fp.read(2))[0]
 
     def readU32(self):
-        return struct.unpack(">I", self.fp.read(4))[0]
+        return U32.unpack(self.fp.read(4))[0]
 
     def read(self, length):
         return self.fp.read(length)
 
+    def skip(self, length):
+        self.fp.seek(length, 1)
+
+
+class LRUCache(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, compute):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            value = compute(key)
+            if len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+
+        self.entries[key] = value
+        return value
+
+
+class Descriptor(object):
+    # A decoded field or method descriptor, generic signatures work too. The
+    # same instance is handed to everyone asking for the same string so it
+    # must not be changed
+
+    def __init__(self, value):
+        self.value = value
+
+        pos = 0
+        if value.startswith("<"):
+            # Formal type parameters of a generic signature
+            pos = self.skipBrackets(value, pos)
+
+        if value[pos:pos + 1] == "(":
+            parameters = []
+            pos += 1
+            while value[pos:pos + 1] != ")":
+                type, pos = self.parseType(value, pos)
+                parameters.append(type)
+
+            self.parameters = tuple(parameters)
+            self.returnType, pos = self.parseType(value, pos + 1)
+            self.type = None
+        else:
+            # Anything after the first type, like the interfaces of a class
+            # signature, is left out
+            self.parameters = ()
+            self.returnType = None
+            self.type, pos = self.parseType(value, pos)
+
+        types = self.parameters if self.type is None else (self.type, )
+        self.slots = sum([2 if type in ("J", "D") else 1 for type in types])
+
+    def isMethod(self):
+        return self.type is None
+
+    @classmethod
+    def skipBrackets(cls, value, pos):
+        depth = 0
+        while True:
+            if pos >= len(value):
+                raise ClassError("Unterminated descriptor '%s'" % (value, ))
+
+            if value[pos] == "<":
+                depth += 1
+            elif value[pos] == ">":
+                depth -= 1
+                if depth == 0:
+                    return pos + 1
+
+            pos += 1
+
+    @classmethod
+    def parseType(cls, value, pos):
+        start = pos
+        while value[pos:pos + 1] == "[":
+            pos += 1
+
+        c = value[pos:pos + 1]
+        if c == "L" or c == "T":
+            while value[pos:pos + 1] != ";":
+                if pos >= len(value):
+                    raise ClassError("Unterminated descriptor '%s'" % (value, ))
+                if value[pos] == "<":
+                    pos = cls.skipBrackets(value, pos)
+                else:
+                    pos += 1
+        elif not c or c not in "BCDFIJSZV":
+            raise ClassError("Bad descriptor '%s' at %d" % (value, pos))
+
+        return intern(value[start:pos + 1]), pos + 1
+
+    def __repr__(self):
+        return "Descriptor(%r)" % (self.value, )
+
+
+descriptors = LRUCache(DESCRIPTOR_CACHE_SIZE)
+
+
+def descriptor(value):
+    # Decoded descriptor for value, shared across the process
+    return descriptors.get(value, Descriptor)
+
 
 class Constant(object):
     SIZE = 1
+    # How many constants deep the key has to resolve
+    DEPTH = 0
 
     def __init__(self, pool):
         self.pool = pool
+        self.cachedKey = None
+
+    def key(self):
+        # Fully resolved canonical key, e.g. (TAG, class name, method name,
+        # descriptor) for a MethodRef
+        if self.cachedKey is None:
+            self.cachedKey = self.computeKey()
+
+        return self.cachedKey
+
+    def __eq__(self, other):
+        return isinstance(other, Constant) and self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
 
     def __repr__(self):
         return str(self)
@@ -46,7 +308,7 @@ class NumberConstant(Constant):
         self.value = reader.read(size)
 
     def data(self):
-        return struct.pack(">c%ds" % (len(self.value), ), self.__class__.TAG, self.value)
+        return self.__class__.TAG + self.value
 
     def pretty(self):
         return "%s: %s\n" % (self.__class__.__name__, repr(self.value))
@@ -54,8 +316,11 @@ class NumberConstant(Constant):
     def update(self, mapping):
         pass
 
-    def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.value == other.value
+    def verify(self, pool, errors):
+        pass
+
+    def computeKey(self):
+        return (self.__class__.TAG, self.value)
 
     def __str__(self):
         return "[ %s: %s ]" % (self.__class__.__name__, repr(self.value))
@@ -92,6 +357,7 @@ class DoubleConstant(NumberConstant):
 
 
 class RefConstant(Constant):
+    DEPTH = 2
 
     def __init__(self, reader, pool):
         super(RefConstant, self).__init__(pool)
@@ -99,41 +365,51 @@ class RefConstant(Constant):
         self.nameAndTypeIndex = reader.readU16()
 
     def data(self):
-        return struct.pack(">cHH", self.__class__.TAG, self.classIndex, self.nameAndTypeIndex)
+        return TAG_U16X2.pack(self.__class__.TAG, self.classIndex, self.nameAndTypeIndex)
 
     def update(self, mapping):
         self.classIndex = mapping[self.classIndex]
         self.nameAndTypeIndex = mapping[self.nameAndTypeIndex]
+        self.cachedKey = None
+
+    def verify(self, pool, errors):
+        checkIndex(pool, self.classIndex, ClassConstant, self.__class__.__name__, errors)
+        checkIndex(pool, self.nameAndTypeIndex, NameAndTypeConstant, self.__class__.__name__, errors)
+
+    def computeKey(self):
+        return (self.__class__.TAG, ) + resolve(self.pool, self.classIndex)[1:] + resolve(self.pool, self.nameAndTypeIndex)[1:]
 
     def pretty(self):
         return "%s: %d, %d\n" % (self.__class__.__name__, self.classIndex, self.nameAndTypeIndex)
 
-    def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.pool[self.classIndex] == other.pool[other.classIndex] and self.pool[self.nameAndTypeIndex] == other.pool[other.nameAndTypeIndex]
-
     def __str__(self):
         return "[ %s: %d %d ]" % (self.__class__.__name__, self.classIndex, self.nameAndTypeIndex)
 
 
 class StringConstant(Constant):
     TAG = "\x08"
+    DEPTH = 1
 
     def __init__(self, reader, pool):
         super(StringConstant, self).__init__(pool)
         self.stringIndex = reader.readU16()
 
     def data(self):
-        return struct.pack(">cH", self.__class__.TAG, self.stringIndex)
+        return TAG_U16.pack(self.__class__.TAG, self.stringIndex)
 
     def update(self, mapping):
         self.stringIndex = mapping[self.stringIndex]
+        self.cachedKey = None
+
+    def verify(self, pool, errors):
+        checkIndex(pool, self.stringIndex, Utf8Constant, self.__class__.__name__, errors)
+
+    def computeKey(self):
+        return (self.__class__.TAG, ) + resolve(self.pool, self.stringIndex)[1:]
 
     def pretty(self):
         return "%s: %d\n" % (self.__class__.__name__, self.stringIndex)
 
-    def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.pool[self.stringIndex] == other.pool[other.stringIndex]
-
     def __str__(self):
         return "[ %s: %d ]" % (self.__class__.__name__, self.stringIndex)
 
@@ -161,23 +437,28 @@ class InterfaceMethodRefConstant(RefConstant):
 
 class ClassConstant(Constant):
     TAG = "\x07"
+    DEPTH = 1
 
     def __init__(self, reader, pool):
         super(ClassConstant, self).__init__(pool)
         self.nameIndex = reader.readU16()
 
     def data(self):
-        return struct.pack(">cH", self.__class__.TAG, self.nameIndex)
+        return TAG_U16.pack(self.__class__.TAG, self.nameIndex)
 
     def update(self, mapping):
         self.nameIndex = mapping[self.nameIndex]
+        self.cachedKey = None
+
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, self.__class__.__name__, errors)
+
+    def computeKey(self):
+        return (self.__class__.TAG, ) + resolve(self.pool, self.nameIndex)[1:]
 
     def pretty(self):
         return "%s: %d\n" % (self.__class__.__name__, self.nameIndex)
 
-    def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.pool[self.nameIndex] == other.pool[other.nameIndex]
-
     def __str__(self):
         return "[ %s: %d ]" % (self.__class__.__name__, self.nameIndex)
 
@@ -189,25 +470,37 @@ class Utf8Constant(Constant):
         super(Utf8Constant, self).__init__(pool)
         self.length = reader.readU16()
         self.bytes = reader.read(self.length)
+        self.decoded = None
 
     def data(self):
-        return struct.pack(">cH", self.__class__.TAG, self.length) + self.bytes
+        return TAG_U16.pack(self.__class__.TAG, self.length) + self.bytes
 
     def update(self, mapping):
         pass
 
+    def verify(self, pool, errors):
+        pass
+
+    def computeKey(self):
+        return (self.__class__.TAG, self.bytes)
+
+    def descriptor(self):
+        # Only for constants that hold a descriptor or signature
+        if self.decoded is None:
+            self.decoded = descriptor(self.bytes)
+
+        return self.decoded
+
     def pretty(self):
         return "%s: %d '%s'\n" % (self.__class__.__name__, self.length, self.bytes)
 
-    def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.length == other.length and self.bytes == other.bytes
-
     def __str__(self):
         return "[ %s: %d \"%s\" ]" % (self.__class__.__name__, self.length, self.bytes)
 
 
 class NameAndTypeConstant(Constant):
     TAG = "\x0C"
+    DEPTH = 1
 
     def __init__(self, reader, pool):
         super(NameAndTypeConstant, self).__init__(pool)
@@ -217,20 +510,46 @@ class NameAndTypeConstant(Constant):
     def update(self, mapping):
         self.nameIndex = mapping[self.nameIndex]
         self.descriptorIndex = mapping[self.descriptorIndex]
+        self.cachedKey = None
+
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, self.__class__.__name__, errors)
+        checkIndex(pool, self.descriptorIndex, Utf8Constant, self.__class__.__name__, errors)
+
+    def computeKey(self):
+        return (self.__class__.TAG, ) + resolve(self.pool, self.nameIndex)[1:] + resolve(self.pool, self.descriptorIndex)[1:]
 
     def data(self):
-        return struct.pack(">cHH", self.__class__.TAG, self.nameIndex, self.descriptorIndex)
+        return TAG_U16X2.pack(self.__class__.TAG, self.nameIndex, self.descriptorIndex)
 
     def pretty(self):
         return "%s: %d, %d\n" % (self.__class__.__name__, self.nameIndex, self.descriptorIndex)
 
-    def __eq__(self, other):
-        return self.__class__ == other.__class__ and self.pool[self.nameIndex] == other.pool[other.nameIndex] and self.pool[self.descriptorIndex] == other.pool[other.descriptorIndex]
-
     def __str__(self):
         return "[ %s: %d %d ]" % (self.__class__.__name__, self.nameIndex, self.descriptorIndex)
 
 
+class Interface(object):
+
+    def __init__(self, reader):
+        self.index = reader.readU16()
+
+    def data(self):
+        return U16.pack(self.index)
+
+    def update(self, mapping):
+        self.index = mapping[self.index]
+
+    def verify(self, pool, errors):
+        checkIndex(pool, self.index, ClassConstant, "Interface", errors)
+
+    def structure(self, pool):
+        return resolve(pool, self.index)
+
+    def pretty(self):
+        return "Index: %d\n" % (self.index, )
+
+
 class Field(object):
 
     def __init__(self, reader, constantPool):
@@ -244,13 +563,19 @@ class Field(object):
             self.attributes.append(Attribute.parse(reader, constantPool))
 
     def data(self):
-        buf = struct.pack(">HHHH", self.accessFlags, self.nameIndex, self.descriptorIndex, len(self.attributes))
+        buf = U16X4.pack(self.accessFlags, self.nameIndex, self.descriptorIndex, len(self.attributes))
 
         for attribute in self.attributes:
             buf += attribute.data()
 
         return buf
 
+    def write(self, fp):
+        fp.write(U16X4.pack(self.accessFlags, self.nameIndex, self.descriptorIndex, len(self.attributes)))
+
+        for attribute in self.attributes:
+            attribute.write(fp)
+
     def update(self, mapping):
         self.nameIndex = mapping[self.nameIndex]
         self.descriptorIndex = mapping[self.descriptorIndex]
@@ -258,6 +583,25 @@ class Field(object):
         for attribute in self.attributes:
             attribute.update(mapping)
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "Field", errors)
+        checkIndex(pool, self.descriptorIndex, Utf8Constant, "Field", errors)
+
+        for attribute in self.attributes:
+            attribute.verify(pool, errors)
+
+    def name(self, pool):
+        return "%s %s" % (pool[self.nameIndex].bytes, pool[self.descriptorIndex].bytes)
+
+    def descriptor(self, pool):
+        return pool[self.descriptorIndex].descriptor()
+
+    def size(self):
+        return 8 + sum([attribute.size() for attribute in self.attributes])
+
+    def structure(self, pool):
+        return (self.accessFlags, resolve(pool, self.nameIndex), resolve(pool, self.descriptorIndex), tuple([attribute.structure(pool) for attribute in self.attributes]))
+
     def pretty(self):
         buf = "AccessFlags: %d\n" % (self.accessFlags, )
         buf += "NameIndex: %d\n" % (self.nameIndex, )
@@ -283,19 +627,61 @@ class Method(object):
             self.attributes.append(Attribute.parse(reader, constantPool))
 
     def data(self):
-        buf = struct.pack(">HHHH", self.accessFlags, self.nameIndex, self.descriptorIndex, len(self.attributes))
+        buf = U16X4.pack(self.accessFlags, self.nameIndex, self.descriptorIndex, len(self.attributes))
 
         for attribute in self.attributes:
             buf += attribute.data()
 
         return buf
 
-    def update(self, mapping):
+    def write(self, fp):
+        fp.write(U16X4.pack(self.accessFlags, self.nameIndex, self.descriptorIndex, len(self.attributes)))
+
+        for attribute in self.attributes:
+            attribute.write(fp)
+
+    def update(self, mapping, code=True):
         self.nameIndex = mapping[self.nameIndex]
         self.descriptorIndex = mapping[self.descriptorIndex]
 
         for attribute in self.attributes:
-            attribute.update(mapping)
+            if isinstance(attribute, CodeAttribute):
+                attribute.update(mapping, code)
+            else:
+                attribute.update(mapping)
+
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "Method", errors)
+        checkIndex(pool, self.descriptorIndex, Utf8Constant, "Method", errors)
+
+        constant = pool.get(self.descriptorIndex)
+        if isinstance(constant, Utf8Constant):
+            try:
+                slots = constant.descriptor().slots
+            except ClassError, e:
+                errors.append("Method: %s" % (e, ))
+            else:
+                # The arguments, and this, are the first locals
+                if not self.accessFlags & STATIC:
+                    slots += 1
+                for attribute in self.attributes:
+                    if isinstance(attribute, CodeAttribute) and attribute.maxLocals < slots:
+                        errors.append("Method: %d locals, arguments need %d" % (attribute.maxLocals, slots))
+
+        for attribute in self.attributes:
+            attribute.verify(pool, errors)
+
+    def name(self, pool):
+        return "%s %s" % (pool[self.nameIndex].bytes, pool[self.descriptorIndex].bytes)
+
+    def descriptor(self, pool):
+        return pool[self.descriptorIndex].descriptor()
+
+    def size(self):
+        return 8 + sum([attribute.size() for attribute in self.attributes])
+
+    def structure(self, pool):
+        return (self.accessFlags, resolve(pool, self.nameIndex), resolve(pool, self.descriptorIndex), tuple([attribute.structure(pool) for attribute in self.attributes]))
 
     def pretty(self):
         buf = "AccessFlags: %d\n" % (self.accessFlags, )
@@ -309,8 +695,55 @@ class Method(object):
         return buf
 
 
+class Records(list):
+    # Entries of an attribute, any change drops the size the attribute has
+    # cached. owner is None while unpickling
+
+    owner = None
+
+    def __init__(self, owner, items=()):
+        list.__init__(self, items)
+        self.owner = owner
+
+
+def invalidating(method):
+    def wrapper(self, *args):
+        if self.owner is not None:
+            self.owner.invalidate()
+        return method(self, *args)
+
+    return wrapper
+
+
+for name in ("append", "extend", "insert", "remove", "pop", "__setitem__", "__delitem__", "__setslice__", "__delslice__", "__iadd__", "__imul__"):
+    setattr(Records, name, invalidating(getattr(list, name)))
+
+
+def sized(name, records=False):
+    # Property for something the size of an attribute depends on, setting
+    # it drops the cached size. With records the value is kept as Records
+    # so changing the list in place does too
+    key = name + "Value"
+
+    def get(self):
+        return getattr(self, key)
+
+    def set(self, value):
+        if records:
+            value = Records(self, value)
+        setattr(self, key, value)
+        self.invalidate()
+
+    return property(get, set)
+
+
 class Attribute(object):
 
+    # Size in bytes including the name index and length, computed from the
+    # content the first time it is needed. Content that changes the size is
+    # behind sized() properties which call invalidate()
+    cachedSize = None
+
     @classmethod
     def parse(cls, reader, constantPool):
         nameIndex = reader.readU16()
@@ -318,6 +751,8 @@ class Attribute(object):
 
         if isinstance(constant, Utf8Constant):
             if constant.bytes == "Code":
+                if reader.stream:
+                    return StreamCodeAttribute(nameIndex, reader, constantPool)
                 return CodeAttribute(nameIndex, reader, constantPool)
             if constant.bytes == "Signature" or constant.bytes == "SourceFile":
                 return SignatureAttribute(nameIndex, reader, constantPool)
@@ -332,20 +767,45 @@ class Attribute(object):
 
         return UnknownAttribute(nameIndex, reader, constantPool)
 
+    def write(self, fp):
+        fp.write(self.data())
+
+    def size(self):
+        if self.cachedSize is None:
+            self.cachedSize = self.computeSize()
+
+        return self.cachedSize
+
+    def invalidate(self):
+        # Remapping pool indexes never changes the size, so update() does
+        # not need this
+        self.cachedSize = None
+
 
 class UnknownAttribute(Attribute):
 
+    rawData = sized("rawData")
+
     def __init__(self, nameIndex, reader, constantPool):
         self.nameIndex = nameIndex
         length = reader.readU32()
         self.rawData = reader.read(length)
 
     def data(self):
-        return struct.pack(">HI", self.nameIndex, len(self.rawData)) + self.rawData
+        return ATTRIBUTE.pack(self.nameIndex, len(self.rawData)) + self.rawData
 
     def update(self, mapping):
         self.nameIndex = mapping[self.nameIndex]
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "UnknownAttribute", errors)
+
+    def computeSize(self):
+        return 6 + len(self.rawData)
+
+    def structure(self, pool):
+        return (resolve(pool, self.nameIndex), self.rawData)
+
     def pretty(self):
         buf = "NameIndex: %d\n" % (self.nameIndex, )
         buf += "Length: %d\n" % (len(self.rawData), )
@@ -360,20 +820,28 @@ class ExceptionChild(object):
         self.exceptionIndex = reader.readU16()
 
     def data(self):
-        return struct.pack(">H", self.exceptionIndex)
+        return U16.pack(self.exceptionIndex)
 
     def update(self, mapping):
         self.exceptionIndex = mapping[self.exceptionIndex]
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.exceptionIndex, ClassConstant, "Exception", errors)
+
+    def structure(self, pool):
+        return resolve(pool, self.exceptionIndex)
+
     def pretty(self):
         return "ExceptionIndex: %d\n" % (self.exceptionIndex, )
 
 
 class ExceptionAttribute(Attribute):
 
+    exceptions = sized("exceptions", True)
+
     def __init__(self, nameIndex, reader, constantPool):
         self.nameIndex = nameIndex
-        self.length = reader.readU32()
+        reader.readU32() # skip length, we will calculate it when needed
 
         length = reader.readU16()
         self.exceptions = []
@@ -381,7 +849,7 @@ class ExceptionAttribute(Attribute):
             self.exceptions.append(ExceptionChild(reader))
 
     def data(self):
-        buf = struct.pack(">HIH", self.nameIndex, self.length, len(self.exceptions))
+        buf = ATTRIBUTE_U16.pack(self.nameIndex, self.size() - 6, len(self.exceptions))
         for exception in self.exceptions:
             buf += exception.data()
 
@@ -392,9 +860,20 @@ class ExceptionAttribute(Attribute):
         for exception in self.exceptions:
             exception.update(mapping)
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "ExceptionAttribute", errors)
+        for exception in self.exceptions:
+            exception.verify(pool, errors)
+
+    def computeSize(self):
+        return 8 + 2 * len(self.exceptions)
+
+    def structure(self, pool):
+        return (resolve(pool, self.nameIndex), tuple([exception.structure(pool) for exception in self.exceptions]))
+
     def pretty(self):
         buf = "NameIndex: %d\n" % (self.nameIndex, )
-        buf += "Length: %d\n" % (self.length, )
+        buf += "Length: %d\n" % (self.size() - 6, )
 
         buf += "Exceptions (%d)\n" % (len(self.exceptions), )
         for exception in self.exceptions:
@@ -412,13 +891,21 @@ class InnerClass(object):
         self.accessFlags = reader.readU16()
 
     def data(self):
-        return struct.pack(">HHHH", self.innerClassInfoIndex, self.outerClassInfoIndex, self.innerNameIndex, self.accessFlags)
+        return U16X4.pack(self.innerClassInfoIndex, self.outerClassInfoIndex, self.innerNameIndex, self.accessFlags)
 
     def update(self, mapping):
         self.innerClassInfoIndex = mapping[self.innerClassInfoIndex]
         self.outerClassInfoIndex = mapping[self.outerClassInfoIndex]
         self.innerNameIndex = mapping[self.innerNameIndex]
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.innerClassInfoIndex, ClassConstant, "InnerClass", errors)
+        checkIndex(pool, self.outerClassInfoIndex, ClassConstant, "InnerClass", errors, True)
+        checkIndex(pool, self.innerNameIndex, Utf8Constant, "InnerClass", errors, True)
+
+    def structure(self, pool):
+        return (resolve(pool, self.innerClassInfoIndex), resolve(pool, self.outerClassInfoIndex), resolve(pool, self.innerNameIndex), self.accessFlags)
+
     def pretty(self):
         buf = "InnerClassInfoIndex: %d\n" % (self.innerClassInfoIndex, )
         buf += "OuterClassInfoIndex: %d\n" % (self.outerClassInfoIndex, )
@@ -430,9 +917,11 @@ class InnerClass(object):
 
 class InnerClassesAttribute(Attribute):
 
+    classes = sized("classes", True)
+
     def __init__(self, nameIndex, reader, constantPool):
         self.nameIndex = nameIndex
-        self.length = reader.readU32()
+        reader.readU32() # skip length, we will calculate it when needed
 
         length = reader.readU16()
         self.classes = []
@@ -440,7 +929,7 @@ class InnerClassesAttribute(Attribute):
             self.classes.append(InnerClass(reader))
 
     def data(self):
-        buf = struct.pack(">HIH", self.nameIndex, self.length, len(self.classes))
+        buf = ATTRIBUTE_U16.pack(self.nameIndex, self.size() - 6, len(self.classes))
         for c in self.classes:
             buf += c.data()
 
@@ -451,9 +940,20 @@ class InnerClassesAttribute(Attribute):
         for c in self.classes:
             c.update(mapping)
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "InnerClassesAttribute", errors)
+        for c in self.classes:
+            c.verify(pool, errors)
+
+    def computeSize(self):
+        return 8 + 8 * len(self.classes)
+
+    def structure(self, pool):
+        return (resolve(pool, self.nameIndex), tuple([c.structure(pool) for c in self.classes]))
+
     def pretty(self):
         buf = "NameIndex: %d\n" % (self.nameIndex, )
-        buf += "Length: %d\n" % (self.length, )
+        buf += "Length: %d\n" % (self.size() - 6, )
 
         buf += "Classes (%d)\n" % (len(self.classes), )
         for c in self.classes:
@@ -471,11 +971,17 @@ class ExceptionTableChild(object):
         self.catchType = reader.readU16()
 
     def data(self):
-        return struct.pack(">HHHH", self.startPc, self.endPc, self.handlerPc, self.catchType)
+        return U16X4.pack(self.startPc, self.endPc, self.handlerPc, self.catchType)
 
     def update(self, mapping):
         self.catchType = mapping[self.catchType]
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.catchType, ClassConstant, "ExceptionTable", errors, True)
+
+    def structure(self, pool):
+        return (self.startPc, self.endPc, self.handlerPc, resolve(pool, self.catchType))
+
     def pretty(self):
         buf = "StartPc: %d\n" % (self.startPc, )
         buf += "EndPc: %d\n" % (self.endPc, )
@@ -487,77 +993,36 @@ class ExceptionTableChild(object):
 
 class CodeAttribute(Attribute):
 
-    SKIP_TABLE = {
-        "\x01": 0,
-        "\x02": 0,
-        "\x03": 0,
-        "\x04": 0,
-        "\x05": 0,
-        "\x06": 0,
-        "\x07": 0,
-        "\x08": 0,
-        "\x0a": 0,
-        "\x10": 1,
-        "\x15": 1,
-        "\x19": 1,
-        "\x1b": 0,
-        "\x2a": 0,
-        "\x2b": 0,
-        "\x2c": 0,
-        "\x2d": 0,
-        "\x32": 0,
-        "\x36": 1,
-        "\x3a": 1,
-        "\x3b": 0,
-        "\x3c": 0,
-        "\x3d": 0,
-        "\x3e": 0,
-        "\x4d": 0,
-        "\x4e": 0,
-        "\x57": 0,
-        "\x59": 0,
-        "\x60": 0,
-        "\x61": 0,
-        "\x64": 0,
-        "\x6e": 0,
-        "\x6f": 0,
-        "\x84": 2,
-        "\x85": 0,
-        "\x86": 0,
-        "\x89": 0,
-        "\x8a": 0,
-        "\x8d": 0,
-        "\x99": 2,
-        "\x9a": 2,
-        "\x9b": 2,
-        "\x9c": 2,
-        "\x9d": 2,
-        "\x9e": 2,
-        "\x9f": 2,
-        "\xa0": 2,
-        "\xa1": 2,
-        "\xa2": 2,
-        "\xa3": 2,
-        "\xa4": 2,
-        "\xa7": 2,
-        "\xa8": 2,
-        "\xa9": 1,
-        "\xac": 0,
-        "\xb0": 0,
-        "\xb1": 0,
-        "\xbc": 0,
-        "\xbe": 0,
-        "\xbf": 0,
-        "\xc6": 2,
-        "\xc7": 2,
-    }
+    # Length of every instruction that has one, the switches and wide are
+    # measured in variableLength()
+    LENGTHS = opcodeTable([
+        (0x00, 0x0f, 1), (0x10, 0x10, 2), (0x11, 0x11, 3), (0x12, 0x12, 2),
+        (0x13, 0x14, 3), (0x15, 0x19, 2), (0x1a, 0x35, 1), (0x36, 0x3a, 2),
+        (0x3b, 0x83, 1), (0x84, 0x84, 3), (0x85, 0x98, 1), (0x99, 0xa8, 3),
+        (0xa9, 0xa9, 2), (0xac, 0xb1, 1), (0xb2, 0xb8, 3), (0xb9, 0xba, 5),
+        (0xbb, 0xbb, 3), (0xbc, 0xbc, 2), (0xbd, 0xbd, 3), (0xbe, 0xbf, 1),
+        (0xc0, 0xc1, 3), (0xc2, 0xc3, 1), (0xc5, 0xc5, 4), (0xc6, 0xc7, 3),
+        (0xc8, 0xc9, 5),
+    ])
+
+    TABLE_SWITCH = "\xaa"
+    LOOKUP_SWITCH = "\xab"
+    WIDE = "\xc4"
+
+    # Width of the pool operand right after the opcode
+    POOL_WIDTHS = opcodeTable([
+        (0x12, 0x12, 1), (0x13, 0x14, 2), (0xb2, 0xbb, 2), (0xbd, 0xbd, 2),
+        (0xc0, 0xc1, 2), (0xc5, 0xc5, 2),
+    ])
+
+    exceptionTable = sized("exceptionTable", True)
 
     def __init__(self, nameIndex, reader, constantPool):
         self.nameIndex = nameIndex
-        self.length = reader.readU32() # skip length, we will calculate it when needed
+        reader.readU32() # skip length, we will calculate it when needed
         self.maxStack = reader.readU16()
         self.maxLocals = reader.readU16()
-        self.code = reader.read(reader.readU32())
+        self.readCode(reader)
         length = reader.readU16()
         self.exceptionTable = []
         for i in xrange(0, length):
@@ -569,67 +1034,269 @@ class CodeAttribute(Attribute):
         for i in xrange(0, length):
             self.attributes.append(Attribute.parse(reader, constantPool))
 
+    def readCode(self, reader):
+        self.code = reader.read(reader.readU32())
+        self.buildIndex()
+
+    def buildIndex(self):
+        # Where the pool operands are, remapping never moves them so this
+        # only has to be done once per code array
+        operands, end, more = self.decode(self.code)
+        self.operandOffsets = array.array("I", [offset for offset, width in operands])
+        self.operandWidths = array.array("B", [width for offset, width in operands])
+        self.decodedEnd = end
+        self.unknownOpcode = self.code[end] if end < len(self.code) else None
+
+    def getCode(self):
+        return self.codeValue
+
+    def setCode(self, code):
+        # The operands may have moved, so the index is built again
+        self.codeValue = code
+        self.operandOffsets = None
+        self.invalidate()
+
+    code = property(getCode, setCode)
+
+    def remapped(self, code):
+        # Sets code that differs from the current only in its pool operands,
+        # which keeps the size and the index
+        self.codeValue = code
+
+    def inMemory(self):
+        return True
+
+    def unknown(self):
+        # (offset, opcode) of the first opcode decode() does not know, the
+        # rest of the code is not indexed. None when it knows them all
+        if self.operandOffsets is None:
+            self.buildIndex()
+
+        if self.unknownOpcode is None:
+            return None
+
+        return self.decodedEnd, self.unknownOpcode
+
+    def operands(self):
+        if self.operandOffsets is None:
+            self.buildIndex()
+
+        return itertools.izip(self.operandOffsets, self.operandWidths)
+
+    @classmethod
+    def readOperand(cls, code, offset, width):
+        if width == 1:
+            return ord(code[offset])
+
+        return U16.unpack_from(code, offset)[0]
+
+    def codeChunks(self):
+        yield self.code
+
+    def scan(self):
+        # Walks the code once chunk by chunk. Yields (piece, None) for the
+        # bytes between pool operands and (None, (offset, width, opcode,
+        # index)) for each operand, so callers never index the whole code
+        operands = self.operands()
+        pending = next(operands, None)
+        buf = ""
+        base = 0
+        pos = 0
+        for chunk in self.codeChunks():
+            buf = buf[pos:] + chunk
+            base += pos
+            pos = 0
+
+            while pending is not None and pending[0] + pending[1] <= base + len(buf):
+                offset, width = pending
+                start = offset - base
+                if start > pos:
+                    yield buf[pos:start], None
+                yield None, (offset, width, buf[start - 1], self.readOperand(buf, start, width))
+                pos = start + width
+                pending = next(operands, None)
+
+            # Everything up to the opcode of the next operand can go
+            end = len(buf) if pending is None else min(len(buf), pending[0] - 1 - base)
+            if end > pos:
+                yield buf[pos:end], None
+                pos = end
+
     def data(self):
-        buf = struct.pack(">HIHHI", self.nameIndex, self.length, self.maxStack, self.maxLocals, len(self.code)) + self.code + struct.pack(">H", len(self.exceptionTable))
+        buf = CODE_HEADER.pack(self.nameIndex, self.size() - 6, self.maxStack, self.maxLocals, len(self.code)) + self.code + U16.pack(len(self.exceptionTable))
         for exceptionTableItem in self.exceptionTable:
             buf += exceptionTableItem.data()
-        buf += struct.pack(">H", len(self.attributes))
+        buf += U16.pack(len(self.attributes))
         for attribute in self.attributes:
             buf += attribute.data()
 
         return buf
 
-    def updateCode(self, code, mapping):
-        newCode = ""
+    def codeLength(self):
+        return len(self.code)
 
-        length = len(code)
-        i = 0
-        while i < length:
-            skip = CodeAttribute.SKIP_TABLE.get(code[i])
-            if not skip is None:
-                newCode += code[i:i + skip + 1]
-                i += skip + 1
-                continue
+    def size(self):
+        # Only the code and exception table are cached here, the nested
+        # attributes cache their own sizes so adding, removing or changing
+        # one of them needs no invalidation of this attribute
+        if self.cachedSize is None:
+            self.cachedSize = 18 + self.codeLength() + 8 * len(self.exceptionTable)
 
-            if code[i] == "\x12":
-                index = struct.unpack(">B", code[i+1:i+2])[0]
-                index = mapping[index]
-                newCode += code[i] + struct.pack(">B", index)
-                i += 2
-                continue
+        return self.cachedSize + sum([attribute.size() for attribute in self.attributes])
 
-            if code[i] == "\x13" or code[i] == "\x14" or code[i] == "\xb2" or code[i] == "\xb3" or code[i] == "\xb4" or code[i] == "\xb5" or code[i] == "\xb6" or code[i] == "\xb7" or code[i] == "\xb8" or code[i] == "\xbb" or code[i] == "\xc0":
-                index = struct.unpack(">H", code[i+1:i+3])[0]
-                index = mapping[index]
-                newCode += code[i] + struct.pack(">H", index)
-                i += 3
-                continue
+    def writeCode(self, fp):
+        for chunk in self.codeChunks():
+            fp.write(chunk)
 
-            if code[i] == "\xb9":
-                index = struct.unpack(">H", code[i+1:i+3])[0]
-                index = mapping[index]
-                newCode += code[i] + struct.pack(">H", index) + code[i+3:i+5]
-                i += 5
-                continue
+    def write(self, fp):
+        fp.write(CODE_HEADER.pack(self.nameIndex, self.size() - 6, self.maxStack, self.maxLocals, self.codeLength()))
+        self.writeCode(fp)
+        fp.write(U16.pack(len(self.exceptionTable)))
+        for exceptionTableItem in self.exceptionTable:
+            fp.write(exceptionTableItem.data())
+        fp.write(U16.pack(len(self.attributes)))
+        for attribute in self.attributes:
+            attribute.write(fp)
+
+    # Constant types each pool operand opcode may refer to
+    OPERAND_TYPES = {
+        "\x12": (IntegerConstant, FloatConstant, StringConstant, ClassConstant),
+        "\x13": (IntegerConstant, FloatConstant, StringConstant, ClassConstant),
+        "\x14": (LongConstant, DoubleConstant),
+        "\xb2": FieldRefConstant,
+        "\xb3": FieldRefConstant,
+        "\xb4": FieldRefConstant,
+        "\xb5": FieldRefConstant,
+        "\xb6": MethodRefConstant,
+        "\xb7": (MethodRefConstant, InterfaceMethodRefConstant),
+        "\xb8": (MethodRefConstant, InterfaceMethodRefConstant),
+        "\xb9": InterfaceMethodRefConstant,
+        # There is no InvokeDynamic constant yet, parse() rejects a pool
+        # that has one
+        "\xba": Constant,
+        "\xbb": ClassConstant,
+        "\xbd": ClassConstant,
+        "\xc0": ClassConstant,
+        "\xc1": ClassConstant,
+        "\xc5": ClassConstant,
+    }
 
-            break
+    @classmethod
+    def decode(cls, code, base=0):
+        # Offset and width of every operand that holds a constant pool index,
+        # the offset where decoding stopped and whether it stopped at an
+        # instruction that runs past the end of code. base is the offset of
+        # code in the whole code array, which the switch padding depends on
+        operands = []
 
-        if len(newCode) < len(code):
-            newCode += code[len(newCode):]
+        i = 0
+        while i < len(code):
+            opcode = code[i]
+            length = CodeAttribute.LENGTHS.get(opcode)
+            if length is None:
+                if opcode != CodeAttribute.TABLE_SWITCH and opcode != CodeAttribute.LOOKUP_SWITCH and opcode != CodeAttribute.WIDE:
+                    break
 
-        return newCode
+                length = cls.variableLength(code, i, base + i)
+                if length is None:
+                    return operands, i, True
+                if length <= 0:
+                    break
 
-    def update(self, mapping):
+            if i + length > len(code):
+                return operands, i, True
+
+            width = CodeAttribute.POOL_WIDTHS.get(opcode)
+            if width is not None:
+                operands.append((i + 1, width))
+            i += length
+
+        return operands, i, False
+
+    @classmethod
+    def variableLength(cls, code, i, pc):
+        # Length of the switch or wide at code[i], None when code ends
+        # before the length is known and 0 for a malformed switch
+        if code[i] == CodeAttribute.WIDE:
+            if i + 1 >= len(code):
+                return None
+            if code[i + 1] == "\x84":
+                return 6
+            return 4
+
+        # The operands start at the next multiple of 4 after the opcode
+        start = i + 4 - pc % 4
+        if code[i] == CodeAttribute.TABLE_SWITCH:
+            if start + 12 > len(code):
+                return None
+            low, high = I32X2.unpack_from(code, start + 4)
+            if high < low:
+                return 0
+            return start + 12 + 4 * (high - low + 1) - i
+
+        if start + 8 > len(code):
+            return None
+        pairs = I32.unpack_from(code, start + 4)[0]
+        if pairs < 0:
+            return 0
+        return start + 8 + 8 * pairs - i
+
+    @classmethod
+    def remapOperands(cls, code, operands, mapping):
+        # code is a bytearray that is changed in place
+        for offset, width in operands:
+            if width == 1:
+                code[offset] = mapping[code[offset]]
+            else:
+                index = mapping[code[offset] << 8 | code[offset + 1]]
+                code[offset] = index >> 8
+                code[offset + 1] = index & 0xff
+
+    def update(self, mapping, code=True):
         self.nameIndex = mapping[self.nameIndex]
 
-        self.code = self.updateCode(self.code, mapping)
+        if code:
+            newCode = bytearray(self.code)
+            self.remapOperands(newCode, self.operands(), mapping)
+            self.remapped(str(newCode))
 
+        for exceptionTableItem in self.exceptionTable:
+            exceptionTableItem.update(mapping)
         for attribute in self.attributes:
             attribute.update(mapping)
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "CodeAttribute", errors)
+
+        for piece, operand in self.scan():
+            if operand is not None:
+                offset, width, opcode, index = operand
+                checkIndex(pool, index, CodeAttribute.OPERAND_TYPES[opcode], "CodeAttribute at offset %d" % (offset - 1, ), errors)
+
+        unknown = self.unknown()
+        if unknown is not None:
+            errors.append("CodeAttribute: unknown opcode 0x%02x at offset %d" % (ord(unknown[1]), unknown[0]))
+
+        for exceptionTableItem in self.exceptionTable:
+            exceptionTableItem.verify(pool, errors)
+        for attribute in self.attributes:
+            attribute.verify(pool, errors)
+
+    def structure(self, pool):
+        # The code with every pool operand swapped for the constant it
+        # points at, hashed while it is scanned
+        code = hashlib.sha1()
+        for piece, operand in self.scan():
+            if operand is None:
+                code.update(piece)
+            else:
+                code.update("\0%d:%r" % (operand[0], resolve(pool, operand[3])))
+
+        return (resolve(pool, self.nameIndex), self.maxStack, self.maxLocals, code.digest(), tuple([e.structure(pool) for e in self.exceptionTable]), tuple([attribute.structure(pool) for attribute in self.attributes]))
+
     def pretty(self):
         buf = "NameIndex: %d\n" % (self.nameIndex, )
-        buf += "Length: %d\n" % (self.length, )
+        buf += "Length: %d\n" % (self.size() - 6, )
         buf += "MaxStack: %d\n" % (self.maxStack, )
         buf += "MaxLocals: %d\n" % (self.maxLocals, )
         buf += "Code: %s\n" % (repr(self.code), )
@@ -645,11 +1312,178 @@ class CodeAttribute(Attribute):
         return buf
 
 
+class StreamCodeAttribute(CodeAttribute):
+    # Keeps the code in the class file and rewrites it chunk by chunk when
+    # written, so memory use does not depend on the size of the method. The
+    # operands are decoded from the file whenever they are needed instead of
+    # being indexed, as the index grows with the method too
+
+    CHUNK = 65536
+
+    def readCode(self, reader):
+        self.path = reader.fp.name
+        self.codeSize = reader.readU32()
+        self.offset = reader.fp.tell()
+        self.mappings = []
+        self.loaded = None
+        self.operandOffsets = None
+        # unknown() of the code in the file, False until it was decoded
+        self.fileUnknown = False
+        reader.skip(self.codeSize)
+
+    def getCode(self):
+        # Only for callers that need all of it at once
+        return "".join(self.codeChunks())
+
+    def setCode(self, code):
+        self.loaded = code
+        self.mappings = []
+        self.operandOffsets = None
+        self.invalidate()
+
+    code = property(getCode, setCode)
+
+    def remapped(self, code):
+        self.loaded = code
+        self.mappings = []
+
+    def codeLength(self):
+        if self.loaded is not None:
+            return len(self.loaded)
+
+        return self.codeSize
+
+    def inMemory(self):
+        return self.loaded is not None
+
+    def update(self, mapping, code=True):
+        # The engines leave code that is not in memory to this, even when
+        # they pass code=False
+        if self.loaded is None:
+            self.mappings.append(mapping)
+            code = False
+
+        super(StreamCodeAttribute, self).update(mapping, code)
+
+    def unknown(self):
+        if self.loaded is not None:
+            return super(StreamCodeAttribute, self).unknown()
+
+        if self.fileUnknown is False:
+            for piece in self.rawPieces():
+                pass
+
+        return self.fileUnknown
+
+    def operands(self):
+        if self.loaded is not None:
+            return super(StreamCodeAttribute, self).operands()
+
+        return self.fileOperands()
+
+    def fileOperands(self):
+        # Remapping keeps every operand in place, so these are the operands
+        # of the remapped code too
+        for base, piece, operands in self.rawPieces():
+            if operands:
+                for offset, width in operands:
+                    yield base + offset, width
+
+    def scan(self):
+        if self.loaded is not None:
+            for item in super(StreamCodeAttribute, self).scan():
+                yield item
+            return
+
+        for base, piece, operands in self.pieces():
+            pos = 0
+            for offset, width in operands or ():
+                if offset > pos:
+                    yield piece[pos:offset], None
+                yield None, (base + offset, width, piece[offset - 1], self.readOperand(piece, offset, width))
+                pos = offset + width
+
+            if pos < len(piece):
+                yield piece[pos:], None
+
+    def rawChunks(self):
+        with open(self.path, "rb") as source:
+            source.seek(self.offset)
+            remaining = self.codeSize
+            while remaining:
+                chunk = source.read(min(StreamCodeAttribute.CHUNK, remaining))
+                if not chunk:
+                    raise ClassError("Code of %s is truncated" % (self.path, ))
+                remaining -= len(chunk)
+                yield chunk
+
+    def rawPieces(self):
+        # The code as it is in the file cut at instruction boundaries, as
+        # (offset, piece, operands) with the operands relative to the piece.
+        # After an unknown opcode the rest comes with operands None
+        buf = ""
+        base = 0
+        decoding = True
+        for chunk in itertools.chain(self.rawChunks(), [None]):
+            last = chunk is None
+            if not last:
+                buf += chunk
+
+            if not decoding:
+                if buf:
+                    yield base, buf, None
+                    base += len(buf)
+                    buf = ""
+                continue
+
+            # An instruction cut off at the end of buf is kept and decoded
+            # again once the next chunk is read
+            operands, end, more = self.decode(buf, base)
+            if end < len(buf) and (last or not more):
+                decoding = False
+                self.fileUnknown = (base + end, buf[end])
+
+            yield base, buf[:end], operands
+            base += end
+            buf = buf[end:]
+
+            if last and buf:
+                yield base, buf, None
+
+        if decoding:
+            self.fileUnknown = None
+
+    def codeChunks(self):
+        if self.loaded is not None:
+            yield self.loaded
+            return
+
+        if not self.mappings:
+            for chunk in self.rawChunks():
+                yield chunk
+            return
+
+        for base, piece, operands in self.pieces():
+            yield piece
+
+    def pieces(self):
+        # rawPieces() with the queued mappings applied
+        for base, piece, operands in self.rawPieces():
+            if operands and self.mappings:
+                piece = bytearray(piece)
+                for mapping in self.mappings:
+                    self.remapOperands(piece, operands, mapping)
+                piece = str(piece)
+            yield base, piece, operands
+
+
 class LocalVariableTableAttribute(Attribute):
 
+    localVariables = sized("localVariables", True)
+
     def __init__(self, nameIndex, reader, constantPool):
         self.nameIndex = nameIndex
-        self.length = reader.readU32() # skip length, we will calculate it when needed
+        reader.readU32() # skip length, we will calculate it when needed
 
         length = reader.readU16()
         self.localVariables = []
@@ -657,7 +1491,7 @@ class LocalVariableTableAttribute(Attribute):
             self.localVariables.append(LocalVariable(reader))
 
     def data(self):
-        buf = struct.pack(">HIH", self.nameIndex, self.length, len(self.localVariables))
+        buf = ATTRIBUTE_U16.pack(self.nameIndex, self.size() - 6, len(self.localVariables))
         for localVariable in self.localVariables:
             buf += localVariable.data()
 
@@ -668,9 +1502,20 @@ class LocalVariableTableAttribute(Attribute):
         for localVariable in self.localVariables:
             localVariable.update(mapping)
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "LocalVariableTableAttribute", errors)
+        for localVariable in self.localVariables:
+            localVariable.verify(pool, errors)
+
+    def computeSize(self):
+        return 8 + 10 * len(self.localVariables)
+
+    def structure(self, pool):
+        return (resolve(pool, self.nameIndex), tuple([localVariable.structure(pool) for localVariable in self.localVariables]))
+
     def pretty(self):
         buf = "NameIndex: %d\n" % (self.nameIndex, )
-        buf += "Length: %d\n" % (self.length, )
+        buf += "Length: %d\n" % (self.size() - 6, )
 
         buf += "LocalVariables (%d)\n" % (len(self.localVariables), )
         for localVariable in self.localVariables:
@@ -686,7 +1531,7 @@ class LineNumber(object):
         self.lineNumber = reader.readU16()
 
     def data(self):
-        return struct.pack(">HH", self.pc, self.lineNumber)
+        return U16X2.pack(self.pc, self.lineNumber)
 
     def update(self, lineMapping):
         #self.lineNumber = lineMapping.get(self.lineNumber)
@@ -701,9 +1546,11 @@ class LineNumber(object):
 
 class LineNumberTableAttribute(Attribute):
 
+    lineNumbers = sized("lineNumbers", True)
+
     def __init__(self, nameIndex, reader, constantPool):
         self.nameIndex = nameIndex
-        self.length = reader.readU32() # skip length, we will calculate it when needed
+        reader.readU32() # skip length, we will calculate it when needed
 
         length = reader.readU16()
         self.lineNumbers = []
@@ -711,7 +1558,7 @@ class LineNumberTableAttribute(Attribute):
             self.lineNumbers.append(LineNumber(reader))
 
     def data(self):
-        buf = struct.pack(">HIH", self.nameIndex, self.length, len(self.lineNumbers))
+        buf = ATTRIBUTE_U16.pack(self.nameIndex, self.size() - 6, len(self.lineNumbers))
         for lineNumber in self.lineNumbers:
             buf += lineNumber.data()
 
@@ -722,9 +1569,18 @@ class LineNumberTableAttribute(Attribute):
         for lineNumber in self.lineNumbers:
             lineNumber.update(mapping)
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "LineNumberTableAttribute", errors)
+
+    def computeSize(self):
+        return 8 + 4 * len(self.lineNumbers)
+
+    def structure(self, pool):
+        return (resolve(pool, self.nameIndex), tuple([(lineNumber.pc, lineNumber.lineNumber) for lineNumber in self.lineNumbers]))
+
     def pretty(self):
         buf = "NameIndex: %d\n" % (self.nameIndex, )
-        buf += "Length: %d\n" % (self.length, )
+        buf += "Length: %d\n" % (self.size() - 6, )
 
         buf += "LineNumbers (%d)\n" % (len(self.lineNumbers), )
         for lineNumber in self.lineNumbers:
@@ -741,12 +1597,22 @@ class SignatureAttribute(Attribute):
         self.signatureIndex = reader.readU16()
 
     def data(self):
-        return struct.pack(">HIH", self.nameIndex, 2, self.signatureIndex)
+        return ATTRIBUTE_U16.pack(self.nameIndex, 2, self.signatureIndex)
 
     def update(self, mapping):
         self.nameIndex = mapping[self.nameIndex]
         self.signatureIndex = mapping[self.signatureIndex]
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "SignatureAttribute", errors)
+        checkIndex(pool, self.signatureIndex, Utf8Constant, "SignatureAttribute", errors)
+
+    def computeSize(self):
+        return 8
+
+    def structure(self, pool):
+        return (resolve(pool, self.nameIndex), resolve(pool, self.signatureIndex))
+
     def pretty(self):
         buf = "NameIndex: %d\n" % (self.nameIndex, )
         buf += "Length: %d\n" % (2, )
@@ -763,12 +1629,22 @@ class SourceFileAttribute(Attribute):
         self.sourceFileIndex = reader.readU16()
 
     def data(self):
-        return struct.pack(">HIH", self.nameIndex, 2, self.sourceFileIndex)
+        return ATTRIBUTE_U16.pack(self.nameIndex, 2, self.sourceFileIndex)
 
     def update(self, mapping):
         self.nameIndex = mapping[self.nameIndex]
         self.sourceFileIndex = mapping[self.sourceFileIndex]
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "SourceFileAttribute", errors)
+        checkIndex(pool, self.sourceFileIndex, Utf8Constant, "SourceFileAttribute", errors)
+
+    def computeSize(self):
+        return 8
+
+    def structure(self, pool):
+        return (resolve(pool, self.nameIndex), resolve(pool, self.sourceFileIndex))
+
     def pretty(self):
         buf = "NameIndex: %d\n" % (self.nameIndex, )
         buf += "Length: %d\n" % (2, )
@@ -787,12 +1663,19 @@ class LocalVariable(object):
         self.index = reader.readU16()
 
     def data(self):
-        return struct.pack(">HHHHH", self.startPc, self.length, self.nameIndex, self.descriptorIndex, self.index)
+        return U16X5.pack(self.startPc, self.length, self.nameIndex, self.descriptorIndex, self.index)
 
     def update(self, mapping):
         self.nameIndex = mapping[self.nameIndex]
         self.descriptorIndex = mapping[self.descriptorIndex]
 
+    def verify(self, pool, errors):
+        checkIndex(pool, self.nameIndex, Utf8Constant, "LocalVariable", errors)
+        checkIndex(pool, self.descriptorIndex, Utf8Constant, "LocalVariable", errors)
+
+    def structure(self, pool):
+        return (self.startPc, self.length, resolve(pool, self.nameIndex), resolve(pool, self.descriptorIndex), self.index)
+
     def pretty(self):
         buf = "StartPC: %d\n" % (self.startPc, )
         buf += "Length: %d\n" % (self.length, )
@@ -802,6 +1685,157 @@ class LocalVariable(object):
 
         return buf
 
+class Patch(object):
+
+    # Record types
+    POOL_SIZE = "\x01"
+    POOL_DELETE = "\x02"
+    POOL_ADD = "\x03"
+    POOL_MOVE = "\x04"
+
+    def __init__(self, size, delIndexes, newIndexes, mapping=None, constants=None):
+        # size is the pool count of the old class, delIndexes are old slots
+        # (both of them for a Long or Double) and newIndexes are where the
+        # added constants go in the new pool
+        self.size = size
+        self.delIndexes = delIndexes
+        self.newIndexes = newIndexes
+        self.explicitMapping = mapping
+        # data() of each added constant, in the same order as newIndexes
+        if constants is None:
+            constants = [""] * len(newIndexes)
+        self.constants = constants
+
+    @classmethod
+    def create(cls, size, delIndexes, newIndexes, constants, mapping):
+        # mapping only has to cover the kept constants. It is stored when
+        # the derived mapping gets one of them wrong, filled in with the
+        # derived one for the other slots
+        patch = cls(size, delIndexes, newIndexes, None, constants)
+        derived = patch.mapping()
+
+        deleted = set(delIndexes)
+        for old, new in mapping.iteritems():
+            if old not in deleted and derived[old] != new:
+                derived.update(mapping)
+                patch.explicitMapping = derived
+                break
+
+        return patch
+
+    def newSlots(self):
+        slots = set()
+        for index, constant in zip(self.newIndexes, self.constants):
+            slots.add(index)
+            if constant[:1] == LongConstant.TAG or constant[:1] == DoubleConstant.TAG:
+                slots.add(index + 1)
+
+        return slots
+
+    def mapping(self):
+        # A diff of reordered pools and a composed patch carry their
+        # mapping. Otherwise the kept constants stay in order and fill the
+        # slots the added ones leave free. Deleted slots map to 0, which
+        # keeps composed patches and patches applied in sequence in step
+        if self.explicitMapping is not None:
+            return self.explicitMapping
+
+        deleted = set(self.delIndexes)
+        taken = self.newSlots()
+
+        mapping = {0: 0}
+        j = 1
+        for i in xrange(1, self.size):
+            if i in deleted:
+                mapping[i] = 0
+            else:
+                while j in taken:
+                    j += 1
+
+                mapping[i] = j
+                j += 1
+
+        return mapping
+
+    def constantChange(self):
+        return len(self.newSlots()) - len(self.delIndexes)
+
+    def data(self):
+        buf = Patch.POOL_SIZE + writeVarint(self.size)
+
+        if self.delIndexes:
+            buf += Patch.POOL_DELETE + writeIndexes(self.delIndexes)
+
+        if self.newIndexes:
+            buf += Patch.POOL_ADD + writeIndexes(self.newIndexes)
+            for constant in self.constants:
+                buf += writeVarint(len(constant)) + constant
+
+        if self.explicitMapping is not None:
+            moves = sorted([(old, new) for old, new in self.explicitMapping.iteritems() if old != new])
+            buf += Patch.POOL_MOVE + writeIndexes([old for old, new in moves])
+            for old, new in moves:
+                buf += writeVarint(new)
+
+        return buf
+
+    @classmethod
+    def parse(cls, data):
+        size = None
+        delIndexes = []
+        newIndexes = []
+        constants = []
+        mapping = None
+
+        pos = 0
+        while pos < len(data):
+            record = data[pos]
+            pos += 1
+
+            if record == Patch.POOL_SIZE:
+                size, pos = readVarint(data, pos)
+            elif record == Patch.POOL_DELETE:
+                delIndexes, pos = readIndexes(data, pos)
+            elif record == Patch.POOL_ADD:
+                newIndexes, pos = readIndexes(data, pos)
+                for index in newIndexes:
+                    length, pos = readVarint(data, pos)
+                    constants.append(data[pos:pos + length])
+                    pos += length
+            elif record == Patch.POOL_MOVE:
+                olds, pos = readIndexes(data, pos)
+                mapping = dict([(i, i) for i in xrange(0, size)])
+                for old in olds:
+                    mapping[old], pos = readVarint(data, pos)
+            else:
+                raise ClassError("Unknown patch record %d" % (ord(record), ))
+
+        if size is None:
+            raise ClassError("Patch without pool size")
+
+        return cls(size, delIndexes, newIndexes, mapping, constants)
+
+    def apply(self, cls, engine=None):
+        # Remaps the class and rebuilds its pool, which then is the pool the
+        # patch was made against
+        mapping = self.mapping()
+        if engine is None:
+            cls.update(mapping)
+        else:
+            loadEngine(engine).update(cls, mapping)
+
+        deleted = set(self.delIndexes)
+        constants = dict([(mapping[i], constant) for i, constant in cls.constantPool.iteritems() if i not in deleted])
+        for index, data in zip(self.newIndexes, self.constants):
+            if index in constants:
+                raise ClassError("Patch adds a constant at used index %d" % (index, ))
+            constants[index] = Class.parseConstant(data, cls.constantPool)
+
+        cls.constantPool.clear()
+        cls.constantPool.update(constants)
+        cls.constantPoolSize = max([i + constant.SIZE for i, constant in constants.iteritems()] or [1])
+
+
 class Class(object):
 
     CONSTANT_MAP = {
@@ -818,16 +1852,17 @@ class Class(object):
         NameAndTypeConstant.TAG: NameAndTypeConstant
     }
 
-    def __init__(self, path):
+    def __init__(self, path, stream=False):
         self.path = path
-        self.constantChange = 0
+        self.stream = stream
+        self.structureHashes = None
 
     def pretty(self):
         buf = "Magic: "+ repr("\xCA\xFE\xBA\xBE") +"\n"
         buf += "Version: %d.%d\n" % (self.version[1] , self.version[0])
 
         # Constant Pool
-        buf += "ConstantPool (%d)\n" % (self.constantPoolSize + self.constantChange, )
+        buf += "ConstantPool (%d)\n" % (self.constantPoolSize, )
         for c in sorted(self.constantPool.keys()):
             buf += indent(self.constantPool[c].pretty(), 4)
 
@@ -857,58 +1892,151 @@ class Class(object):
 
         return buf
 
+    def repack(self, other):
+        # Reorders this pool so constants shared with other keep the index
+        # they have there. New constants fill the gaps left by deleted ones
+        # or go at the end, which keeps index churn between releases low.
+        # Returns None and leaves the class as it is when a constant loaded
+        # with ldc would not get an index below 256
+        computeKeys(self.constantPool)
+        computeKeys(other.constantPool)
+
+        # ldc only has one byte for the index
+        ldc = set()
+        for attribute in self.codeAttributes():
+            for piece, operand in attribute.scan():
+                if operand is not None and operand[1] == 1:
+                    ldc.add(operand[3])
+
+        oldIndexes = {}
+        for i in sorted(other.constantPool.keys()):
+            oldIndexes.setdefault(other.constantPool[i].key(), i)
+
+        used = set()
+        mapping = {}
+        pending = []
+        for i in sorted(self.constantPool.keys()):
+            constant = self.constantPool[i]
+            index = oldIndexes.get(constant.key())
+            if index is not None and index > 0xff and i in ldc:
+                index = None
+            if index is not None and index not in used:
+                mapping[i] = index
+                used.update(xrange(index, index + constant.SIZE))
+            else:
+                pending.append(i)
+
+        def fits(index, size):
+            for j in xrange(index, index + size):
+                if j in used:
+                    return False
+
+            return True
+
+        # The ldc ones first so they get the lowest free indexes
+        pending.sort(key=lambda i: i not in ldc)
+
+        free = 1
+        for i in pending:
+            size = self.constantPool[i].SIZE
+            index = free
+            while not fits(index, size):
+                index += 1
+
+            mapping[i] = index
+            used.update(xrange(index, index + size))
+            while free in used:
+                free += 1
+
+        # Close the gaps that are left by moving the constants at the end
+        # of the pool down, or with an empty Utf8 where one does not fit
+        constants = dict([(index, self.constantPool[i]) for i, index in mapping.iteritems()])
+        reverse = dict([(index, i) for i, index in mapping.iteritems()])
+        while True:
+            end = max(used) + 1
+            gaps = [j for j in xrange(1, end) if j not in used]
+            if not gaps:
+                break
+
+            gap = gaps[0]
+            last = max(constants)
+            constant = constants[last]
+            if last > gap and (constant.SIZE == 1 or gap + 1 not in used):
+                del constants[last]
+                used.difference_update(xrange(last, last + constant.SIZE))
+                constants[gap] = constant
+                used.update(xrange(gap, gap + constant.SIZE))
+                i = reverse.pop(last, None)
+                if i is not None:
+                    mapping[i] = gap
+                    reverse[gap] = i
+            else:
+                constants[gap] = Utf8Constant(Reader(StringIO("\x00\x00")), self.constantPool)
+                used.add(gap)
+
+        for i in ldc:
+            if mapping[i] > 0xff:
+                return None
+
+        # Optional indexes such as a missing catch type are 0
+        mapping[0] = 0
+        self.update(mapping)
+
+        self.constantPool.clear()
+        self.constantPool.update(constants)
+        self.constantPoolSize = max(used) + 1
+        computeKeys(self.constantPool)
+
+        return mapping
+
     def findDiffConstants(self, firstPool, secondPool):
+        computeKeys(firstPool)
+        computeKeys(secondPool)
+
+        keys = set([constant.key() for constant in secondPool.itervalues()])
+
         indexes = []
         for i, constant in firstPool.iteritems():
-            found = False
-            for otherConstant in secondPool.itervalues():
-                if constant == otherConstant:
-                    found = True
-                    break
-
-            if not found:
+            if constant.key() not in keys:
                 indexes.append(i)
 
         return indexes
 
-    def diff(self, other):
+    def diff(self, other, engine=None):
         # Should really found the minimum number of moves that needs to be done
         # to change selfs constantPool to others constantPool but we start with
         # just handle adds and removes
 
-        mapping = dict([(i, i) for i in xrange(1, self.constantPoolSize + 1)])
-
-        patch = ""
-
-        constantPool = copy.copy(self.constantPool)
-
-        newIndexes = self.findDiffConstants(other.constantPool, self.constantPool)
-
-        delIndexes = self.findDiffConstants(self.constantPool, other.constantPool)
-
-        if delIndexes:
-            patch += struct.pack(">BH", 0, len(delIndexes))
-            for index in delIndexes:
-                patch += struct.pack(">H", index)
-
-                for i in xrange(self.constantPoolSize, 0, -1):
-                    if mapping[i] <= index:
-                        break
-
-                    mapping[i] -= 1
-
-        if newIndexes:
-            patch += struct.pack(">BH", 0, len(newIndexes))
-            for index in newIndexes:
-                patch += struct.pack(">H", index)
-
-                for i in xrange(self.constantPoolSize, 0, -1):
-                    if mapping[i] <= index:
-                        break
-
-                    mapping[i] += 1
-
-        self.constantChange = len(newIndexes) - len(delIndexes)
+        # Every constant is matched with the first unused equal constant in
+        # other, the ones left over on either side are deleted or added.
+        # Constants with no equal one in other at all are found up front
+        if engine == NUMPY:
+            pool = loadEngine(engine)
+            missing = pool.findDiffConstants(pool.ColumnPool(self.poolData(), 0), pool.ColumnPool(other.poolData(), 0))
+        else:
+            missing = self.findDiffConstants(self.constantPool, other.constantPool)
+        missing = set(missing)
+
+        computeKeys(self.constantPool)
+        computeKeys(other.constantPool)
+
+        free = {}
+        for j in sorted(other.constantPool.keys(), reverse=True):
+            free.setdefault(other.constantPool[j].key(), []).append(j)
+
+        mapping = {0: 0}
+        delIndexes = []
+        for i in sorted(self.constantPool.keys()):
+            constant = self.constantPool[i]
+            indexes = None if i in missing else free.get(constant.key())
+            if indexes:
+                mapping[i] = indexes.pop()
+            else:
+                delIndexes.extend(xrange(i, i + constant.SIZE))
+
+        newIndexes = sorted([j for indexes in free.itervalues() for j in indexes])
+
+        patch = Patch.create(self.constantPoolSize, delIndexes, newIndexes, [other.constantPool[i].data() for i in newIndexes], mapping)
 
         """
         for i, constant in enumerate(other.constantPool):
@@ -929,8 +2057,37 @@ class Class(object):
                     mapping[j] += 1
         """
 
-        with open('patch', 'wb') as fp:
-            fp.write(patch)
+        patch.apply(self, engine)
+
+        return patch
+
+    @classmethod
+    def parseConstant(cls, data, pool):
+        # A constant from its data(), as carried in a patch
+        return Class.CONSTANT_MAP[data[0]](Reader(StringIO(data[1:])), pool)
+
+    def codeAttributes(self, inMemory=False):
+        # With inMemory streamed code that is still in the file is left out
+        attributes = []
+        for method in self.methods:
+            for attribute in method.attributes:
+                if isinstance(attribute, CodeAttribute) and (not inMemory or attribute.inMemory()):
+                    attributes.append(attribute)
+
+        return attributes
+
+    def computeSizes(self):
+        # Fills the attribute size caches bottom up before the class is
+        # written, only attributes invalidated since the last pass are
+        # measured again. Returns the size of everything after the pool
+        size = 14 + 2 * len(self.interfaces)
+        for member in self.fields + self.methods + self.attributes:
+            size += member.size()
+
+        return size
+
+    def update(self, mapping, code=True):
+        self.structureHashes = None
 
         for constant in self.constantPool.values():
             constant.update(mapping)
@@ -943,85 +2100,183 @@ class Class(object):
         for field in self.fields:
             field.update(mapping)
         for method in self.methods:
-            method.update(mapping)
+            method.update(mapping, code)
         for attribute in self.attributes:
             attribute.update(mapping)
 
+    def verify(self, pending=()):
+        # Check that every pool index is in range and points at the right
+        # kind of constant. The fields and methods in pending are left to
+        # bsdiff by a patch, in those a deleted constant (index 0) is fine
+        errors = []
+
+        for constant in self.constantPool.itervalues():
+            constant.verify(self.constantPool, errors)
+
+        pending = set(pending)
+        if pending:
+            pendingPool = dict(self.constantPool)
+            pendingPool[0] = DELETED
+
+        checkIndex(self.constantPool, self.thisClass, ClassConstant, "ThisClass", errors)
+        checkIndex(self.constantPool, self.superClass, ClassConstant, "SuperClass", errors, True)
+
+        for interface in self.interfaces:
+            interface.verify(self.constantPool, errors)
+        for member in self.fields + self.methods:
+            member.verify(pendingPool if member in pending else self.constantPool, errors)
+        for attribute in self.attributes:
+            attribute.verify(self.constantPool, errors)
+
+        return errors
+
+    def hashes(self):
+        # Structural hash of every element, these ignore the pool indexes so
+        # two classes that only differ in pool order hash the same
+        if self.structureHashes is None:
+            pool = self.constantPool
+            computeKeys(pool)
+            self.structureHashes = {
+                "pool": hash(frozenset([constant.key() for constant in pool.itervalues()])),
+                "header": hash((self.version, self.accessFlags, resolve(pool, self.thisClass), resolve(pool, self.superClass))),
+                # The members are compared by name below, this catches them
+                # being reordered
+                "order": hash((tuple([field.name(pool) for field in self.fields]), tuple([method.name(pool) for method in self.methods]))),
+                "interfaces": [hash(interface.structure(pool)) for interface in self.interfaces],
+                "fields": dict([(field.name(pool), hash(field.structure(pool))) for field in self.fields]),
+                "methods": dict([(method.name(pool), hash(method.structure(pool))) for method in self.methods]),
+                "attributes": [hash(attribute.structure(pool)) for attribute in self.attributes],
+            }
+
+        return self.structureHashes
+
+    def compare(self, other):
+        # Returns the members that differ, an empty list means the classes
+        # are identical apart from pool renumbering
+        first = self.hashes()
+        second = other.hashes()
+
+        differences = []
+        for key in ("pool", "header", "order", "interfaces", "attributes"):
+            if first[key] != second[key]:
+                differences.append(key)
+
+        for key, kind in (("fields", "field"), ("methods", "method")):
+            for name in sorted(set(first[key]) | set(second[key])):
+                if first[key].get(name) != second[key].get(name):
+                    differences.append("%s %s" % (kind, name))
+
+        return differences
+
+    def poolData(self):
+        buf = U16.pack(self.constantPoolSize)
+        for c in sorted(self.constantPool.keys()):
+            buf += self.constantPool[c].data()
+
+        return buf
+
     def data(self):
+        self.computeSizes()
+
         buf = "\xCA\xFE\xBA\xBE"
-        buf += struct.pack(">HH", *self.version)
+        buf += U16X2.pack(*self.version)
 
         # Constants
-        buf += struct.pack(">H", self.constantPoolSize + self.constantChange)
-        for c in sorted(self.constantPool.keys()):
-            buf += self.constantPool[c].data()
+        buf += self.poolData()
 
-        buf += struct.pack(">HHH", self.accessFlags, self.thisClass, self.superClass)
+        buf += U16X3.pack(self.accessFlags, self.thisClass, self.superClass)
 
         # Interfaces
-        buf += struct.pack(">H", len(self.interfaces))
+        buf += U16.pack(len(self.interfaces))
         for interface in self.interfaces:
             buf += interface.data()
 
         # Fields
-        buf += struct.pack(">H", len(self.fields))
+        buf += U16.pack(len(self.fields))
         for field in self.fields:
             buf += field.data()
 
         # Methods
-        buf += struct.pack(">H", len(self.methods))
+        buf += U16.pack(len(self.methods))
         for method in self.methods:
             buf += method.data()
 
         # Attributes
-        buf += struct.pack(">H", len(self.attributes))
+        buf += U16.pack(len(self.attributes))
         for attribute in self.attributes:
             buf += attribute.data()
 
         return buf
 
+    def write(self, fp):
+        # Same as data() but written piece by piece to fp
+        self.computeSizes()
+
+        fp.write("\xCA\xFE\xBA\xBE")
+        fp.write(U16X2.pack(*self.version))
+
+        fp.write(self.poolData())
+
+        fp.write(U16X3.pack(self.accessFlags, self.thisClass, self.superClass))
+
+        fp.write(U16.pack(len(self.interfaces)))
+        for interface in self.interfaces:
+            fp.write(interface.data())
+
+        fp.write(U16.pack(len(self.fields)))
+        for field in self.fields:
+            field.write(fp)
+
+        fp.write(U16.pack(len(self.methods)))
+        for method in self.methods:
+            method.write(fp)
+
+        fp.write(U16.pack(len(self.attributes)))
+        for attribute in self.attributes:
+            attribute.write(fp)
+
     def parse(self):
         with open(self.path) as fp:
-            r = Reader(fp)
-            if r.read(4) != "\xCA\xFE\xBA\xBE":
-                raise ClassError("Wrong magic")
+            self.parseFile(fp)
 
-            self.version = struct.unpack(">HH", r.read(4))
+    def parseFile(self, fp):
+        r = Reader(fp, self.stream)
+        if r.read(4) != "\xCA\xFE\xBA\xBE":
+            raise ClassError("Wrong magic")
 
-            self.constantPoolSize = r.readU16()
-            self.constantPool = {}
+        self.version = U16X2.unpack(r.read(4))
 
-            i = 1
-            while i < self.constantPoolSize:
-                type = fp.read(1)
-                c = Class.CONSTANT_MAP[type]
-                self.constantPool[i] = c(r, self.constantPool)
-                i += c.SIZE
+        self.constantPoolSize = r.readU16()
+        self.constantPool = {}
 
-            print self.constantPool
+        i = 1
+        while i < self.constantPoolSize:
+            type = fp.read(1)
+            c = Class.CONSTANT_MAP[type]
+            self.constantPool[i] = c(r, self.constantPool)
+            i += c.SIZE
 
-            self.accessFlags = r.readU16()
-            self.thisClass = r.readU16()
-            self.superClass = r.readU16()
+        self.accessFlags = r.readU16()
+        self.thisClass = r.readU16()
+        self.superClass = r.readU16()
 
-            count = r.readU16()
-            self.interfaces = []
+        count = r.readU16()
+        self.interfaces = []
 
-            for i in xrange(0, count):
-                # TODO: Implement
-                pass
+        for i in xrange(0, count):
+            self.interfaces.append(Interface(r))
 
-            count = r.readU16()
-            self.fields = []
-            for i in xrange(0, count):
-                self.fields.append(Field(r, self.constantPool))
+        count = r.readU16()
+        self.fields = []
+        for i in xrange(0, count):
+            self.fields.append(Field(r, self.constantPool))
 
-            count = r.readU16()
-            self.methods = []
-            for i in xrange(0, count):
-                self.methods.append(Method(r, self.constantPool))
+        count = r.readU16()
+        self.methods = []
+        for i in xrange(0, count):
+            self.methods.append(Method(r, self.constantPool))
 
-            count = r.readU16()
-            self.attributes = []
-            for i in xrange(0, count):
-                self.attributes.append(Attribute.parse(r, self.constantPool))
+        count = r.readU16()
+        self.attributes = []
+        for i in xrange(0, count):
+            self.attributes.append(Attribute.parse(r, self.constantPool))
@@ -0,0 +1,179 @@
+import functools
+import os
+import sys
+import zipfile
+from cStringIO import StringIO
+
+import java
+
+
+# One permutation MinHash: every feature is hashed once and the hash picks
+# a bin and a value, the signature keeps the smallest value per bin. This
+# keeps fingerprinting linear in the number of features.
+BINS = 64
+BANDS = 16
+ROWS = BINS / BANDS
+
+# Pairs below this estimated Jaccard similarity are not worth diffing
+THRESHOLD = 0.5
+
+MASK = (1 << 64) - 1
+EMPTY = MASK
+
+
+def features(cls):
+    # Canonical constant keys plus method signatures, neither depends on
+    # the pool layout
+    pool = cls.constantPool
+    java.computeKeys(pool)
+
+    result = set([constant.key() for constant in pool.itervalues()])
+    for method in cls.methods:
+        result.add(("method", method.name(pool)))
+    for field in cls.fields:
+        result.add(("field", field.name(pool)))
+
+    return result
+
+
+def signature(items):
+    values = [EMPTY] * BINS
+    for item in items:
+        h = (hash(item) * 0x9E3779B97F4A7C15) & MASK
+        slot = h % BINS
+        value = h / BINS
+        if value < values[slot]:
+            values[slot] = value
+
+    # Densify by borrowing from the next filled bin so two sparse classes
+    # do not match on their empty bins
+    filled = [i for i in xrange(0, BINS) if values[i] != EMPTY]
+    if not filled:
+        return tuple(values)
+
+    result = list(values)
+    for i in xrange(0, BINS):
+        if values[i] == EMPTY:
+            distance = 1
+            while values[(i + distance) % BINS] == EMPTY:
+                distance += 1
+            result[i] = (values[(i + distance) % BINS] + distance * 0x1000193) & MASK
+
+    return tuple(result)
+
+
+def similarity(first, second):
+    same = 0
+    for a, b in zip(first, second):
+        if a == b:
+            same += 1
+
+    return float(same) / BINS
+
+
+class Index(object):
+
+    def __init__(self):
+        self.buckets = {}
+        self.signatures = {}
+
+    def add(self, name, sig):
+        self.signatures[name] = sig
+        for band in xrange(0, BANDS):
+            key = (band, sig[band * ROWS:(band + 1) * ROWS])
+            self.buckets.setdefault(key, []).append(name)
+
+    def candidates(self, sig):
+        names = set()
+        for band in xrange(0, BANDS):
+            names.update(self.buckets.get((band, sig[band * ROWS:(band + 1) * ROWS]), ()))
+
+        return names
+
+    def best(self, sig, threshold=THRESHOLD):
+        best = None
+        bestSimilarity = threshold
+        for name in sorted(self.candidates(sig)):
+            s = similarity(sig, self.signatures[name])
+            if s >= bestSimilarity:
+                best = name
+                bestSimilarity = s
+
+        return best, bestSimilarity
+
+
+def fingerprint(path, data):
+    # Signature of one class, the parsed Class is dropped right after so
+    # only signatures are kept for a whole jar
+    cls = java.Class(path)
+    cls.parseFile(StringIO(data))
+
+    return signature(features(cls))
+
+
+def pair(oldEntries, newEntries, threshold=THRESHOLD):
+    # oldEntries and newEntries map path -> function returning the class
+    # bytes, as from load(). Returns a list of (new path, old path or None,
+    # similarity), exact path matches first. Only classes without an exact
+    # match are read
+    pairs = []
+
+    unmatched = []
+    for path in sorted(newEntries):
+        if path in oldEntries:
+            pairs.append((path, path, 1.0))
+        else:
+            unmatched.append(path)
+
+    if not unmatched:
+        return pairs
+
+    index = Index()
+    for path in sorted(oldEntries):
+        if path not in newEntries:
+            index.add(path, fingerprint(path, oldEntries[path]()))
+
+    for path in unmatched:
+        old, s = index.best(fingerprint(path, newEntries[path]()), threshold)
+        pairs.append((path, old, s if old is not None else 0.0))
+
+    return pairs
+
+
+def readFile(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def load(root):
+    # Every class file under root and every class in the jars under root,
+    # the latter named JAR!ENTRY like corpus.py does
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root)
+            if filename.endswith(".class"):
+                entries[name] = functools.partial(readFile, path)
+            elif filename.endswith(".jar"):
+                jar = zipfile.ZipFile(path)
+                for entry in jar.namelist():
+                    if entry.endswith(".class"):
+                        entries[name +"!"+ entry] = functools.partial(jar.read, entry)
+
+    return entries
+
+
+if __name__ == "__main__":
+    # Prints "new path<TAB>old path" for every class that has a counterpart,
+    # in the old/ and new/ layout patch.py expects, so the output can be fed
+    # to "patch.py -". Classes in jars come out as JAR!ENTRY, which patch.py
+    # does not read. Classes without one are listed on stderr
+    old = sys.argv[1] if len(sys.argv) > 1 else "old"
+    new = sys.argv[2] if len(sys.argv) > 2 else "new"
+
+    for path, oldPath, s in pair(load(old), load(new)):
+        if oldPath is None:
+            print >> sys.stderr, "%s: no counterpart" % (path, )
+        else:
+            print "%s\t%s" % (path, oldPath)
@@ -0,0 +1,84 @@
+import array
+import itertools
+import multiprocessing
+
+import java
+
+
+# Below this much bytecode the process pool costs more than it saves
+MIN_SIZE = 1 << 20
+
+
+def mappingTable(mapping):
+    # Compact u16 array version of a mapping dict, cheap to pickle
+    table = array.array("H", xrange(0, max(mapping) + 1))
+    for old, new in mapping.iteritems():
+        table[old] = new
+
+    return table.tostring()
+
+
+def remapShard(args):
+    items, tableData = args
+
+    table = array.array("H")
+    table.fromstring(tableData)
+
+    codes = []
+    for code, offsets, widths in items:
+        code = bytearray(code)
+        java.CodeAttribute.remapOperands(code, itertools.izip(offsets, widths), table)
+        codes.append(str(code))
+
+    return codes
+
+
+def shards(attributes, count):
+    # Spread the attributes over count shards by code size, keeping the
+    # original position of each so the results can be put back in order
+    buckets = [[0, []] for i in xrange(0, count)]
+    order = sorted(xrange(0, len(attributes)), key=lambda i: -len(attributes[i].code))
+    for i in order:
+        bucket = min(buckets)
+        bucket[0] += len(attributes[i].code)
+        bucket[1].append(i)
+
+    return [indexes for size, indexes in buckets if indexes]
+
+
+def updateCodes(attributes, mapping, processes=None, pool=None):
+    # With one process the pool only adds pickling on top of the serial work
+    processes = processes or multiprocessing.cpu_count()
+    if processes <= 1 or (pool is None and sum([len(attribute.code) for attribute in attributes]) < MIN_SIZE):
+        for attribute in attributes:
+            code = bytearray(attribute.code)
+            java.CodeAttribute.remapOperands(code, attribute.operands(), mapping)
+            attribute.remapped(str(code))
+        return
+
+    ownPool = pool is None
+    if ownPool:
+        pool = multiprocessing.Pool(processes)
+
+    try:
+        tableData = mappingTable(mapping)
+        parts = shards(attributes, processes)
+        for attribute in attributes:
+            # Build the operand index here so workers only patch positions
+            list(attribute.operands())
+
+        results = pool.map(remapShard, [([(attributes[i].code, attributes[i].operandOffsets, attributes[i].operandWidths) for i in indexes], tableData) for indexes in parts])
+    finally:
+        if ownPool:
+            pool.close()
+            pool.join()
+
+    for indexes, codes in zip(parts, results):
+        for i, code in zip(indexes, codes):
+            attributes[i].remapped(code)
+
+
+def update(cls, mapping, processes=None, pool=None):
+    # Class.update with the bytecode rewritten by a process pool
+    updateCodes(cls.codeAttributes(True), mapping, processes, pool)
+    cls.update(mapping, code=False)
@@ -1,38 +1,180 @@
+import container
 import java
 import os
 import sys
+import verify
 
-path = sys.argv[1]
 
-if not os.path.exists("old/"+ path) or not os.path.exists("new/"+ path):
-    print "Usage %s PATH" % (sys.argv[0], )
+def run(path, writer, pretty=True, oldPath=None, debugMode=None, stable=False, stream=False, base=None, engine=None):
+    # oldPath is set when the new class was paired with a differently named
+    # old class. With stream the code of the methods stays in the files and
+    # every check below hashes it chunk by chunk. base is where the patched
+    # class and the dumps are written, by default the file name of path
+    if oldPath is None:
+        oldPath = path
+
+    if base is None:
+        base = os.path.basename(path)
+
+    directory = os.path.dirname(base)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    errors = []
+
+    org = java.Class("old/"+ oldPath, stream)
+    org.parse()
+
+    errors += verify.roundTrip(org, "old/"+ oldPath)
+
+    if pretty:
+        with open(base +".old", "wb") as fp:
+            fp.write(org.pretty())
+
+    # The new method is 122 bytes not including constant pool changes
+
+    reference = java.Class("new/"+ path, stream)
+    reference.parse()
+
+    errors += verify.roundTrip(reference, "new/"+ path)
+    expected = verify.fileDigest("new/"+ path)[0]
+
+    if stable:
+        # The patched class gets the new class with its pool reordered to
+        # follow the old one instead of the new class as built, unless
+        # that would put an ldc constant out of reach
+        if reference.repack(org) is not None:
+            expected = verify.written(reference)[0]
+            errors += verify.structure(reference)
+
+    if pretty:
+        with open(base +".new", "wb") as fp:
+            fp.write(reference.pretty())
+
+    #with open("PerFieldAnalyzerWrapper-3.0.3.class.regenerate", "wb") as fp:
+    #    fp.write(reference.data())
+
+    if debugMode is not None:
+        # Debug attributes go in their own entry, the main patch and the
+        # checks below only cover the rest of the class
+        oldDebug = debug.split(org)
+        oldNames = debug.names(org)
+        newDebug = debug.split(reference)
+        fullExpected = expected
+        expected = verify.written(reference)[0]
+
+    # The patch carries the pool, members that changed are left to bsdiff.
+    # So the pool and the unchanged members are checked and the whole class
+    # only when nothing but the pool changed
+    differences = [difference for difference in org.compare(reference) if difference != "pool"]
+    unchanged = verify.unchanged(org, reference, differences)
+
+    patch = org.diff(reference, engine)
+    writer.add(path, patch)
+
+    errors += verify.pool(org, reference)
+    errors += verify.members(org, unchanged)
+    errors += verify.structure(org, unchanged)
+    if not differences:
+        errors += verify.matches(org, expected)
+
+    if debugMode is not None:
+        stream = debug.encode(oldDebug, newDebug, debugMode)
+        writer.addData(path +"#debug", stream)
+        debug.apply(org, oldDebug, stream, patch.mapping(), oldNames)
+
+    if pretty:
+        with open(base +".patched", "wb") as fp:
+            fp.write(org.pretty())
+
+    # print org.pretty()
+
+    with open(base, "wb") as fp:
+        org.write(fp)
+
+    if debugMode is not None and debugMode == debug.DIFF and not differences:
+        errors += verify.matches(org, fullExpected)
+
+    return errors
+
+
+def exists(path, oldPath=None):
+    return os.path.exists("old/"+ (oldPath or path)) and os.path.exists("new/"+ path)
+
+
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+options = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+
+debugMode = None
+engine = None
+for option in options:
+    if option.startswith("--debug="):
+        debugMode = option[len("--debug="):]
+    if option.startswith("--engine="):
+        engine = option[len("--engine="):]
+
+if debugMode is not None:
+    # Only loaded for --debug, most runs do not need it
+    import debug
+
+stable = "--stable" in options
+stream = "--stream" in options
+
+if len(args) != 1 or (args[0] != "-" and not exists(args[0])) or (debugMode is not None and debugMode not in debug.MODES) or engine not in java.ENGINES + (None, ):
+    print "Usage %s [--debug=strip|carry|diff] [--engine=numpy|parallel] [--stable] [--stream] PATH" % (sys.argv[0], )
+    print "      %s [--debug=strip|carry|diff] [--engine=numpy|parallel] [--stable] [--stream] [--pretty] - < PATHS" % (sys.argv[0], )
+    print "--stream keeps method code in the class files instead of memory, no dumps are written"
+    print "Each line of PATHS is a path or a new path and old path separated by a tab"
     sys.exit(1)
 
-base = os.path.basename(path)
+if args[0] != "-":
+    with open("patch", "wb") as fp:
+        writer = container.ContainerWriter(fp)
+        errors = run(args[0], writer, not stream, debugMode=debugMode, stable=stable, stream=stream, engine=engine)
+        writer.close()
+
+    if errors:
+        for error in errors:
+            print >> sys.stderr, error
+        sys.exit(1)
+
+    sys.exit(0)
 
-org = java.Class("old/"+ path)
-org.parse()
+# Worker mode, one path per line on stdin so a batch only pays for one
+# interpreter startup. All patches go into the same container and the
+# pretty printed dumps are skipped unless asked for. Classes in different
+# directories can share a file name, so the outputs go under patched/ in the
+# same layout as new/.
+pretty = "--pretty" in options
+failed = False
 
-with open(base +".old", "wb") as fp:
-    fp.write(org.pretty())
+with open("patch", "wb") as fp:
+    writer = container.ContainerWriter(fp)
 
-# The new method is 122 bytes not including constant pool changes
+    for line in iter(sys.stdin.readline, ""):
+        line = line.strip()
+        if not line:
+            continue
 
-reference = java.Class("new/"+ path)
-reference.parse()
+        path, _, oldPath = line.partition("\t")
+        oldPath = oldPath or None
 
-with open(base +".new", "wb") as fp:
-    fp.write(reference.pretty())
+        if not exists(path, oldPath):
+            errors = ["%s: missing in old/ or new/" % (path, )]
+        else:
+            try:
+                errors = run(path, writer, pretty, oldPath, debugMode, stable, stream, os.path.join("patched", path), engine)
+            except Exception, e:
+                errors = ["%s: %s" % (path, e)]
 
-#with open("PerFieldAnalyzerWrapper-3.0.3.class.regenerate", "wb") as fp:
-#    fp.write(reference.data())
+        for error in errors:
+            print >> sys.stderr, error
 
-org.diff(reference)
+        print "%s %s" % ("FAIL" if errors else "OK", path)
+        sys.stdout.flush()
 
-with open(base +".patched", "wb") as fp:
-    fp.write(org.pretty())
+        failed = failed or bool(errors)
 
-# print org.pretty()
+    writer.close()
 
-with open(os.path.basename(path), "wb") as fp:
-    fp.write(org.data())
+sys.exit(1 if failed else 0)
@@ -0,0 +1,323 @@
+import array
+import hashlib
+import mmap
+from cStringIO import StringIO
+
+# NumPy is optional and slow to import, so it is only loaded on first use
+numpy = None
+numpyLoaded = False
+
+import java
+
+
+# Constant pool stored as parallel arrays instead of Constant objects. Every
+# slot has a tag, two u16 operand columns and an offset/length pair into the
+# shared buffer (usually a mmap of the class file) for Utf8 and number
+# payloads. Slot 0 and the second slot of a Long/Double have tag 0.
+class ColumnPool(object):
+
+    UTF8 = ord(java.Utf8Constant.TAG)
+    INTEGER = ord(java.IntegerConstant.TAG)
+    FLOAT = ord(java.FloatConstant.TAG)
+    LONG = ord(java.LongConstant.TAG)
+    DOUBLE = ord(java.DoubleConstant.TAG)
+    CLASS = ord(java.ClassConstant.TAG)
+    STRING = ord(java.StringConstant.TAG)
+    FIELD_REF = ord(java.FieldRefConstant.TAG)
+    METHOD_REF = ord(java.MethodRefConstant.TAG)
+    INTERFACE_METHOD_REF = ord(java.InterfaceMethodRefConstant.TAG)
+    NAME_AND_TYPE = ord(java.NameAndTypeConstant.TAG)
+
+    # Tag -> number of u16 operands
+    OPERANDS = {
+        CLASS: 1,
+        STRING: 1,
+        FIELD_REF: 2,
+        METHOD_REF: 2,
+        INTERFACE_METHOD_REF: 2,
+        NAME_AND_TYPE: 2,
+    }
+
+    # Tag -> size of the fixed payload
+    PAYLOAD = {
+        INTEGER: 4,
+        FLOAT: 4,
+        LONG: 8,
+        DOUBLE: 8,
+    }
+
+    def __init__(self, buf, offset=8):
+        self.buf = buf
+        self.start = offset
+        self.count = java.U16.unpack_from(buf, offset)[0]
+
+        self.tags = array.array("B", [0]) * self.count
+        self.first = array.array("H", [0]) * self.count
+        self.second = array.array("H", [0]) * self.count
+        self.offsets = array.array("I", [0]) * self.count
+        self.lengths = array.array("I", [0]) * self.count
+        self.keys = None
+
+        pos = offset + 2
+        i = 1
+        while i < self.count:
+            tag = ord(buf[pos])
+            pos += 1
+            self.tags[i] = tag
+
+            operands = ColumnPool.OPERANDS.get(tag)
+            if operands == 2:
+                self.first[i], self.second[i] = java.U16X2.unpack_from(buf, pos)
+                pos += 4
+            elif operands == 1:
+                self.first[i] = java.U16.unpack_from(buf, pos)[0]
+                pos += 2
+            elif tag == ColumnPool.UTF8:
+                length = java.U16.unpack_from(buf, pos)[0]
+                self.offsets[i] = pos + 2
+                self.lengths[i] = length
+                pos += 2 + length
+            elif tag in ColumnPool.PAYLOAD:
+                self.offsets[i] = pos
+                self.lengths[i] = ColumnPool.PAYLOAD[tag]
+                pos += self.lengths[i]
+            else:
+                raise java.ClassError("Unknown constant tag %d at index %d" % (tag, i))
+
+            if tag == ColumnPool.LONG or tag == ColumnPool.DOUBLE:
+                i += 2
+            else:
+                i += 1
+
+        self.end = pos
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if buf[0:4] != "\xCA\xFE\xBA\xBE":
+            raise java.ClassError("Wrong magic")
+
+        return cls(buf)
+
+    def __len__(self):
+        return self.count
+
+    def indexes(self):
+        return [i for i in xrange(1, self.count) if self.tags[i]]
+
+    def value(self, i):
+        offset = self.offsets[i]
+        return self.buf[offset:offset + self.lengths[i]]
+
+    def key(self, i):
+        if self.keys is None:
+            self.keys = [None] * self.count
+        elif self.keys[i] is not None:
+            return self.keys[i]
+
+        tag = self.tags[i]
+        operands = ColumnPool.OPERANDS.get(tag)
+        # Same layout as Constant.key()
+        if operands == 2:
+            key = (chr(tag), ) + self.key(self.first[i])[1:] + self.key(self.second[i])[1:]
+        elif operands == 1:
+            key = (chr(tag), ) + self.key(self.first[i])[1:]
+        else:
+            key = (chr(tag), self.value(i))
+
+        self.keys[i] = key
+        return key
+
+    def equals(self, i, other, j):
+        if self.tags[i] != other.tags[j]:
+            return False
+
+        return self.key(i) == other.key(j)
+
+    def find(self, other):
+        # Indexes in self that has no equal constant in other
+        keys = set(other.key(j) for j in other.indexes())
+        return [i for i in self.indexes() if self.key(i) not in keys]
+
+    def hashes(self, indexes):
+        return numpy.array([hash(self.key(i)) for i in indexes], dtype=numpy.int64)
+
+    def digests(self, indexes):
+        # First 8 bytes of the sha1 of each key. Unlike a second hash() this
+        # does not collide wherever hash() does, so it can confirm a match
+        if not indexes:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        return numpy.frombuffer("".join([hashlib.sha1(repr(self.key(i))).digest()[:8] for i in indexes]), dtype=numpy.int64)
+
+    def update(self, mapping):
+        # Slots without operands hold 0 in both columns and the table maps 0
+        # to 0, so the columns can be remapped without looking at the tags
+        if loadNumpy() is not None:
+            table = mappingTable(mapping, self.count)
+            self.first = array.array("H", table[numpy.frombuffer(self.first, dtype=numpy.uint16)].tostring())
+            self.second = array.array("H", table[numpy.frombuffer(self.second, dtype=numpy.uint16)].tostring())
+        else:
+            table = array.array("H", xrange(0, self.count))
+            for old, new in mapping.iteritems():
+                if old < self.count:
+                    table[old] = new
+
+            self.first = array.array("H", [table[x] for x in self.first])
+            self.second = array.array("H", [table[x] for x in self.second])
+
+        self.keys = None
+
+    def constant(self, i):
+        return java.Class.CONSTANT_MAP[chr(self.tags[i])](java.Reader(StringIO(self.entry(i)[1:])), None)
+
+    def entry(self, i):
+        tag = self.tags[i]
+        operands = ColumnPool.OPERANDS.get(tag)
+        if operands == 2:
+            return chr(tag) + java.U16X2.pack(self.first[i], self.second[i])
+        if operands == 1:
+            return chr(tag) + java.U16.pack(self.first[i])
+        if tag == ColumnPool.UTF8:
+            return chr(tag) + java.U16.pack(self.lengths[i]) + self.value(i)
+
+        return chr(tag) + self.value(i)
+
+    def toDict(self):
+        constantPool = {}
+        for i in self.indexes():
+            constant = self.constant(i)
+            constant.pool = constantPool
+            constantPool[i] = constant
+
+        return constantPool
+
+    def data(self):
+        buf = [java.U16.pack(self.count)]
+        for i in xrange(1, self.count):
+            if self.tags[i]:
+                buf.append(self.entry(i))
+
+        return "".join(buf)
+
+
+def loadNumpy():
+    global numpy, numpyLoaded
+
+    if not numpyLoaded:
+        numpyLoaded = True
+        try:
+            import numpy as module
+            numpy = module
+        except ImportError:
+            pass
+
+    return numpy
+
+
+def mappingTable(mapping, count=0):
+    size = max(count, max(mapping) + 1 if mapping else 0)
+    table = numpy.arange(size, dtype=numpy.uint32)
+    if mapping:
+        table[numpy.fromiter(mapping.iterkeys(), numpy.uint32, len(mapping))] = numpy.fromiter(mapping.itervalues(), numpy.uint32, len(mapping))
+
+    if table.max() > 0xffff:
+        raise java.ClassError("Constant pool index out of range")
+
+    return table.astype(numpy.uint16)
+
+
+def findDiffConstants(firstPool, secondPool):
+    # Same as Class.findDiffConstants but for two ColumnPools
+    if loadNumpy() is None:
+        return firstPool.find(secondPool)
+
+    firstIndexes = firstPool.indexes()
+    secondIndexes = secondPool.indexes()
+    if not secondIndexes:
+        return firstIndexes
+
+    first = firstPool.hashes(firstIndexes)
+    second = secondPool.hashes(secondIndexes)
+    order = numpy.argsort(second, kind="mergesort")
+    second = second[order]
+
+    # Equal hashes are next to each other after the sort
+    left = numpy.searchsorted(second, first, "left")
+    count = numpy.searchsorted(second, first, "right") - left
+    found = numpy.zeros(len(firstIndexes), dtype=bool)
+
+    # A single candidate is confirmed by comparing digests of both keys
+    single = numpy.flatnonzero(count == 1)
+    if len(single):
+        candidates = order[left[single]]
+        firstCheck = firstPool.digests([firstIndexes[n] for n in single])
+        secondCheck = secondPool.digests([secondIndexes[c] for c in candidates])
+        found[single[firstCheck == secondCheck]] = True
+
+    # Several candidates almost always means the same constant is in the
+    # pool twice, these few are compared key by key
+    for n in numpy.flatnonzero(count > 1):
+        i = firstIndexes[n]
+        for p in xrange(left[n], left[n] + count[n]):
+            if firstPool.equals(i, secondPool, secondIndexes[order[p]]):
+                found[n] = True
+                break
+
+    return [i for n, i in enumerate(firstIndexes) if not found[n]]
+
+
+def updateCodes(attributes, mapping):
+    # Remap the pool operands of many CodeAttributes in one pass
+    if loadNumpy() is None:
+        for attribute in attributes:
+            # The operand index is already built, no need to decode again
+            code = bytearray(attribute.code)
+            java.CodeAttribute.remapOperands(code, attribute.operands(), mapping)
+            attribute.remapped(str(code))
+        return
+
+    narrow = []
+    wide = []
+    base = 0
+    for attribute in attributes:
+        for offset, width in attribute.operands():
+            if width == 1:
+                narrow.append(base + offset)
+            else:
+                wide.append(base + offset)
+        base += len(attribute.code)
+
+    if not narrow and not wide:
+        return
+
+    table = mappingTable(mapping)
+    buf = numpy.frombuffer("".join([attribute.code for attribute in attributes]), dtype=numpy.uint8).copy()
+
+    if wide:
+        wide = numpy.array(wide, dtype=numpy.intp)
+        index = table[(buf[wide].astype(numpy.uint16) << 8) | buf[wide + 1]]
+        buf[wide] = index >> 8
+        buf[wide + 1] = index & 0xff
+
+    if narrow:
+        narrow = numpy.array(narrow, dtype=numpy.intp)
+        index = table[buf[narrow]]
+        if index.max() > 0xff:
+            raise java.ClassError("ldc index out of range")
+        buf[narrow] = index
+
+    data = buf.tostring()
+    base = 0
+    for attribute in attributes:
+        length = len(attribute.code)
+        attribute.remapped(data[base:base + length])
+        base += length
+
+
+def update(cls, mapping):
+    # Class.update with the bytecode of all methods remapped at once
+    updateCodes(cls.codeAttributes(True), mapping)
+    cls.update(mapping, code=False)
@@ -0,0 +1,108 @@
+import hashlib
+
+
+# Read size for fileDigest
+CHUNK = 65536
+
+
+class Digest(object):
+    # File like sink for write(), so a class or member is hashed without
+    # building its data() in memory
+
+    def __init__(self):
+        self.hash = hashlib.sha1()
+        self.length = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.length += len(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def written(item):
+    # Digest and length of what item.write() produces
+    sink = Digest()
+    item.write(sink)
+
+    return sink.hexdigest(), sink.length
+
+
+def fileDigest(path):
+    sink = Digest()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(CHUNK), ""):
+            sink.write(chunk)
+
+    return sink.hexdigest(), sink.length
+
+
+def roundTrip(cls, path):
+    # A freshly parsed class must serialize back to the exact input
+    (data, length), (raw, rawLength) = written(cls), fileDigest(path)
+    if data != raw:
+        return ["%s: data() does not round-trip (%d bytes, expected %d)" % (cls.path, length, rawLength)]
+
+    return []
+
+
+def matches(cls, expected):
+    # Compare the patched class against the digest of the reference so the
+    # reference itself does not have to be kept around
+    if written(cls)[0] != expected:
+        return ["%s: patched output does not match reference %s" % (cls.path, expected)]
+
+    return []
+
+
+def structure(cls, unchanged=None):
+    # With the result of unchanged() the other fields and methods are the
+    # ones a patch left to bsdiff
+    pending = []
+    if unchanged is not None:
+        kept = set([member for name, member, expected in unchanged])
+        pending = [member for member in cls.fields + cls.methods if member not in kept]
+
+    return ["%s: %s" % (cls.path, error) for error in cls.verify(pending)]
+
+
+def pool(cls, reference):
+    # A patched pool is rebuilt from the patch and has to be exactly the
+    # pool of the reference
+    if digest(cls.poolData()) != digest(reference.poolData()):
+        return ["%s: patched constant pool does not match reference" % (cls.path, )]
+
+    return []
+
+
+def unchanged(cls, reference, differences):
+    # Fields and methods compare() found identical in both classes, with
+    # the digest of the reference version. Taken before the patch as the
+    # names of the others may not resolve after it
+    differences = set(differences)
+
+    result = []
+    for kind, members, others in (("field", cls.fields, reference.fields), ("method", cls.methods, reference.methods)):
+        expected = dict([(member.name(reference.constantPool), member) for member in others])
+        for member in members:
+            name = member.name(cls.constantPool)
+            if "%s %s" % (kind, name) not in differences:
+                result.append(("%s %s" % (kind, name), member, written(expected[name])[0]))
+
+    return result
+
+
+def members(cls, unchanged):
+    # Members that did not change have to come out of the patch byte for
+    # byte the same as in the reference
+    errors = []
+    for name, member, expected in unchanged:
+        if written(member)[0] != expected:
+            errors.append("%s: %s does not match reference" % (cls.path, name))
+
+    return errors